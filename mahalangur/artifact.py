@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import argparse
+import joblib
+import json
+import logging
+import numpy as np
+import os
+import struct
+from . import LOG_FORMAT, MODEL_DIR
+from .data.utils import sha256_file
+from .feat import utils
+from .forest import FOREST_ARRAYS, CompiledForest, compile_forest
+from pathlib import Path
+
+
+### Globals
+
+# A model artifact is a single file: the magic bytes, the format version and
+# header length, a JSON header, then the raw forest arrays, each aligned to
+# ARTIFACT_ALIGN bytes so that it can be memory-mapped in place
+ARTIFACT_MAGIC   = b'MHLRF\0'
+ARTIFACT_VERSION = 1
+ARTIFACT_PREFIX  = struct.Struct('<6sHI')
+ARTIFACT_ALIGN   = 64
+
+ARTIFACT_PATH = (MODEL_DIR / 'model-rf_v1.0.artifact').resolve()
+
+# Leaf probabilities are stored as uint16 fractions of VALUE_SCALE, so the
+# mean over the trees is within 0.5/VALUE_SCALE of the exact probability
+VALUE_SCALE = np.iinfo(np.uint16).max
+
+
+### Logic
+
+def threshold_float32(threshold):
+    '''Round float64 thresholds down to float32. sklearn compares float32
+    features with x <= threshold, which for any float32 x holds exactly when
+    x is at most the largest float32 not above the threshold.'''
+    threshold32 = threshold.astype(np.float32)
+    above = threshold32.astype(np.float64) > threshold
+    threshold32[above] = np.nextafter(threshold32[above], np.float32(-np.inf))
+
+    return threshold32
+
+
+def compact_arrays(forest):
+    '''Compact dtypes of the compiled forest arrays'''
+    n_features = forest.feature.max() + 1
+    if n_features > np.iinfo(np.int16).max:
+        raise ValueError('{} features do not fit int16'.format(n_features))
+
+    return {
+        'feature'  : forest.feature.astype(np.int16),
+        'threshold': threshold_float32(forest.threshold),
+        'value'    : np.rint(forest.value * VALUE_SCALE).astype(np.uint16)
+    }
+
+
+def write_artifact(rf_model, artifact_path, metadata):
+    '''Write the fitted forest and the metadata, which must be JSON
+    serializable, to a model artifact file'''
+    arrays = compact_arrays(compile_forest(rf_model))
+
+    header = {
+        'format_version': ARTIFACT_VERSION,
+        'classes'       : rf_model.classes_.tolist(),
+        'value_scale'   : VALUE_SCALE,
+        'arrays'        : {},
+        **metadata
+    }
+
+    # Array offsets are relative to the end of the header, so the header can
+    # be laid out once they are known
+    offset = 0
+    for name in FOREST_ARRAYS:
+        array = arrays[name]
+        header['arrays'][name] = {
+            'dtype' : array.dtype.str,
+            'shape' : array.shape,
+            'offset': offset
+        }
+        offset += -(-array.nbytes // ARTIFACT_ALIGN) * ARTIFACT_ALIGN
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = ARTIFACT_PREFIX.size + len(header_bytes)
+    header_bytes += b' ' * (-data_start % ARTIFACT_ALIGN)
+    data_start = ARTIFACT_PREFIX.size + len(header_bytes)
+
+    temp_path = artifact_path.with_name(artifact_path.name + '.tmp')
+    with open(temp_path, 'wb') as artifact_file:
+        artifact_file.write(ARTIFACT_PREFIX.pack(ARTIFACT_MAGIC,
+                                                 ARTIFACT_VERSION,
+                                                 len(header_bytes)))
+        artifact_file.write(header_bytes)
+
+        for name in FOREST_ARRAYS:
+            artifact_file.seek(data_start + header['arrays'][name]['offset'])
+            artifact_file.write(np.ascontiguousarray(arrays[name]).tobytes())
+    os.replace(temp_path, artifact_path)
+
+    return artifact_path
+
+
+def read_header(artifact_file):
+    magic, version, header_length = ARTIFACT_PREFIX.unpack(
+        artifact_file.read(ARTIFACT_PREFIX.size))
+
+    if magic != ARTIFACT_MAGIC:
+        raise ValueError('not a model artifact')
+    if version != ARTIFACT_VERSION:
+        msg = 'artifact format version {} is not {}'.format(version,
+                                                            ARTIFACT_VERSION)
+        raise ValueError(msg)
+
+    header = json.loads(artifact_file.read(header_length))
+    return header, ARTIFACT_PREFIX.size + header_length
+
+
+def load_artifact(artifact_path):
+    '''Memory-map a model artifact, returning the compiled forest and the
+    artifact header'''
+    with open(artifact_path, 'rb') as artifact_file:
+        header, data_start = read_header(artifact_file)
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        arrays[name] = np.memmap(artifact_path, mode='r',
+                                 dtype=np.dtype(layout['dtype']),
+                                 offset=data_start + layout['offset'],
+                                 shape=tuple(layout['shape']))
+
+    forest = CompiledForest(arrays, header['classes'],
+                            value_scale=header['value_scale'])
+
+    return forest, header
+
+
+def artifact_metadata(model_path, training=None, schema=utils.DATA_SCHEMA):
+    '''Provenance of an artifact converted from the model pickle: the hash of
+    the pickle, the schema its features are encoded with and, if known, the
+    training data hash and metrics'''
+    return {
+        'model_sha256': sha256_file(model_path),
+        'schema'      : schema,
+        'columns'     : utils.schema_columns(schema),
+        'training'    : training or {}
+    }
+
+
+def convert_model(model_path, artifact_path=ARTIFACT_PATH, training=None):
+    '''Convert a pickled random forest to a model artifact'''
+    rf_model = joblib.load(model_path)
+
+    if not artifact_path.parent.exists():
+        artifact_path.parent.mkdir(parents=True)
+
+    return write_artifact(rf_model, artifact_path,
+                          artifact_metadata(model_path, training))
+
+
+def model_artifact():
+    from . import rfmodel
+    import importlib.resources as res
+
+    logger = logging.getLogger('mahalangur.artifact')
+
+    parser = argparse.ArgumentParser(description='Convert a model pickle')
+    parser.add_argument('model_path', nargs='?', default=None,
+                        help='pickle to convert (default: the trained model '
+                             'if there is one, else the package asset)')
+    parser.add_argument('--output', default=str(ARTIFACT_PATH))
+    args = parser.parse_args()
+
+    # Training provenance is known for a model from rfmodel.build_model
+    training = None
+    if args.model_path is not None:
+        model_path = args.model_path
+    elif rfmodel.MODEL_PATH.exists():
+        model_path = rfmodel.MODEL_PATH
+        if rfmodel.MANIFEST_PATH.exists():
+            with open(rfmodel.MANIFEST_PATH, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if (manifest['versions'][-1]['model_sha256'] ==
+                sha256_file(model_path)):
+                training = rfmodel.training_summary(manifest)
+    else:
+        with res.path('mahalangur.assets', 'rfmodel.pickle') as pickle_path:
+            model_path = pickle_path
+
+    artifact_path = Path(args.output).resolve()
+    logger.info('converting \'{}\' to \'{}\''.format(model_path,
+                                                     artifact_path.name))
+    convert_model(model_path, artifact_path, training)
+
+    logger.info('{:.1f} kB pickle, {:.1f} kB artifact'.format(
+        os.path.getsize(model_path)/1024, os.path.getsize(artifact_path)/1024))
+
+    return artifact_path
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    model_artifact()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import argparse
+import csv
+import logging
+import multiprocessing as mp
+import numpy as np
+from . import LOG_FORMAT, MODEL_DIR
+from .rfmodel import (MATRIX_DIR, WORKER_DATA, _init_matrix_worker,
+                      load_matrix, train_model)
+from sklearn.metrics import brier_score_loss, log_loss, roc_auc_score
+from time import perf_counter
+
+
+### Globals
+
+BACKTEST_PATH = (MODEL_DIR / 'backtest_report.csv').resolve()
+
+# Years of training data before the first origin
+BACKTEST_MIN_YEARS = 10
+
+
+### Logic
+
+def year_bounds(matrix, metadata):
+    '''Row ranges of each expedition_year. The cached matrix is ordered by
+    year, so every range is a contiguous slice.'''
+    year_col = metadata['columns'].index('expedition_year')
+    years = np.asarray(matrix['X'][:, year_col]).astype(int)
+
+    if np.any(np.diff(years) < 0):
+        raise ValueError('feature matrix is not ordered by expedition_year')
+
+    unique_years, starts = np.unique(years, return_index=True)
+    stops = np.append(starts[1:], len(years))
+
+    return {int(year): (int(start), int(stop))
+            for year, start, stop in zip(unique_years, starts, stops)}
+
+
+def backtest_origins(bounds, min_years=BACKTEST_MIN_YEARS):
+    '''(origin year, train stop, test start, test stop) for every origin: a
+    model trained on the years up to the origin is tested on the next year
+    with data'''
+    years = sorted(bounds)
+
+    origins = []
+    for origin, test_year in zip(years[min_years-1:-1], years[min_years:]):
+        train_stop = bounds[origin][1]
+        test_start, test_stop = bounds[test_year]
+        origins.append((origin, train_stop, test_start, test_stop))
+
+    return origins
+
+
+def backtest_origin(args):
+    '''Fit on the rows before train_stop and score the test rows. Workers
+    take slices of the memory-mapped matrix, so no process copies the
+    training rows.'''
+    origin, train_stop, test_start, test_stop, params = args
+    X, y = WORKER_DATA['X'], WORKER_DATA['y']
+
+    start = perf_counter()
+    rf_model = train_model(X[:train_stop], y[:train_stop], n_jobs=1, **params)
+    fit_seconds = perf_counter() - start
+
+    X_test, y_test = X[test_start:test_stop], y[test_start:test_stop]
+
+    start = perf_counter()
+    proba = rf_model.predict_proba(X_test)[:, 1]
+    predict_seconds = perf_counter() - start
+
+    # A year where every member succeeded, or none did, has no AUC
+    auc = np.nan
+    if np.unique(y_test).size == 2:
+        auc = roc_auc_score(y_test, proba)
+
+    return {
+        'origin'      : origin,
+        'train_rows'  : train_stop,
+        'test_rows'   : test_stop - test_start,
+        'success_rate': float(np.mean(y_test)),
+        'accuracy'    : float(np.mean((proba > 0.5) == y_test)),
+        'auc'         : auc,
+        'log_loss'    : log_loss(y_test, proba, labels=[0, 1]),
+        'brier'       : brier_score_loss(y_test, proba),
+        'oob_score'   : rf_model.oob_score_,
+        'fit_s'       : fit_seconds,
+        'predict_s'   : predict_seconds
+    }
+
+
+def run_backtest(key_dir, origins, params={}, n_jobs=None):
+    '''Fit and score every origin across a process pool, returning the
+    per-origin results ordered by year and the total wall time'''
+    logger = logging.getLogger('mahalangur.backtest')
+
+    tasks = [origin + (params,) for origin in origins]
+
+    start = perf_counter()
+    results = []
+    with mp.Pool(n_jobs, initializer=_init_matrix_worker,
+                 initargs=(key_dir,)) as pool:
+        for result in pool.imap_unordered(backtest_origin, tasks):
+            logger.info('origin {}: auc {:.4f}, fit {:.2f}s'
+                        .format(result['origin'], result['auc'],
+                                result['fit_s']))
+            results.append(result)
+    wall_seconds = perf_counter() - start
+
+    return sorted(results, key=lambda result: result['origin']), wall_seconds
+
+
+def write_report(results, report_path):
+    headers = list(results[0])
+
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=headers)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key: '{:.5f}'.format(value)
+                                  if isinstance(value, float) else value
+                             for key, value in result.items()})
+
+    return report_path
+
+
+def backtest(min_years=BACKTEST_MIN_YEARS, n_jobs=None):
+    logger = logging.getLogger('mahalangur.backtest')
+
+    matrix, metadata = load_matrix()
+    key_dir = MATRIX_DIR / metadata['sha256']
+
+    origins = backtest_origins(year_bounds(matrix, metadata), min_years)
+    logger.info('backtesting {} origins'.format(len(origins)))
+
+    results, wall_seconds = run_backtest(key_dir, origins, n_jobs=n_jobs)
+
+    if not BACKTEST_PATH.parent.exists():
+        BACKTEST_PATH.parent.mkdir(parents=True)
+
+    logger.info('writing report to \'{}\''.format(BACKTEST_PATH.name))
+    write_report(results, BACKTEST_PATH)
+
+    fit_seconds = sum(result['fit_s'] for result in results)
+    logger.info('{} fits in {:.1f}s wall time, {:.1f}s of fitting'
+                .format(len(results), wall_seconds, fit_seconds))
+    logger.info('mean auc {:.4f}'.format(
+        np.nanmean([result['auc'] for result in results])))
+
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    parser = argparse.ArgumentParser(
+        description='Rolling-origin backtest over expedition years')
+    parser.add_argument('--min-years', type=int, default=BACKTEST_MIN_YEARS,
+                        help='years of training data before the first origin')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    backtest(min_years=args.min_years, n_jobs=args.n_jobs)
@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import multiprocessing as mp
+import numpy as np
+import tempfile
+from . import LOG_FORMAT
+from .feat import utils
+from pathlib import Path
+from time import perf_counter
+
+
+### Timing
+
+def time_call(func, repeat=100, warmup=5):
+    '''Call func repeat times and return the wall times in seconds'''
+    for _ in range(warmup):
+        func()
+
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = perf_counter()
+        func()
+        times[i] = perf_counter() - start
+
+    return times
+
+
+def report(rows, headers):
+    '''Print a fixed width table of benchmark results'''
+    widths = [max(len(str(v)) for v in col) for col in zip(headers, *rows)]
+    line = '  '.join('{:>' + str(w) + '}' for w in widths)
+
+    print(line.format(*headers))
+    for row in rows:
+        print(line.format(*row))
+
+
+def latency_row(name, times):
+    ms = 1000*times
+    return [name, len(ms), '{:.3f}'.format(ms.mean()),
+            '{:.3f}'.format(np.percentile(ms, 50)),
+            '{:.3f}'.format(np.percentile(ms, 99))]
+
+
+LATENCY_HEADERS = ['case', 'n', 'mean_ms', 'p50_ms', 'p99_ms']
+
+
+def process_memory():
+    '''Resident, proportional and unique set sizes of this process in MB
+    (Linux only)'''
+    fields = {}
+    with open('/proc/self/smaps_rollup', 'r') as smaps_file:
+        for line in smaps_file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])/1024
+
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'uss': fields['Private_Clean'] + fields['Private_Dirty']
+    }
+
+
+### Benchmarks
+
+def bench_match(cutoffs=(0.5, 0.2), repeat=3):
+    '''Compare the pairs per second of scoring peak name candidates one pair
+    at a time against the vectorized, memoized scorer, matching the bundled
+    OSM and MoTCA peak lists to the reference peak list. Lower cutoffs give
+    larger candidate sets.'''
+    import importlib.resources as res
+    import pandas as pd
+    from .feat import peak
+    from Levenshtein import jaro_winkler
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.preprocessing import normalize
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    meta_dir = 'mahalangur.data.metadata'
+    name_dfs = {}
+    for source, file_name, id_col in [('ref', 'ref_peak.txt', 'peak_id'    ),
+                                      ('osm', 'osm_peak.txt', 'peak_id'    ),
+                                      ('mot', 'mot_peak.txt', 'peak_number')]:
+        with res.path(meta_dir, file_name) as dsv_path:
+            peaks = peak.read_peaks(dsv_path, id_col=id_col)
+        name_dfs[source] = peak.name_dataframe(peaks, name1='peak_name',
+                                               name2='alt_names')
+
+    def loop_score(name1_df, name2_df, i, j, name_sim_cs):
+        matches = []
+        for k in range(len(i)):
+            match1 = name1_df.iloc[i[k]]
+            match2 = name2_df.iloc[j[k]]
+
+            name_sim_jw = jaro_winkler(match1['name'], match2['name'], 0.1)
+            similarity = (name_sim_cs[k] + name_sim_jw)/2
+
+            titles = match1['title'].split()
+            title_sim = peak.jaccard(titles, match2['title'].split())
+            if match1['title'] != '':
+                title_weight = min(len(titles), 2)*0.1
+                similarity = (title_weight*title_sim +
+                              (1-title_weight)*similarity)
+
+            matches.append([
+                match1['id'], match1['seq'], match1['full_name'],
+                match1['name'], match1['title'],
+                match2['id'], match2['seq'], match2['full_name'],
+                match2['name'], match2['title'],
+                name_sim_cs[k], name_sim_jw, title_sim, similarity
+            ])
+
+        return pd.DataFrame(data=matches, columns=peak.MATCH_HEADERS)
+
+    name1_df = name_dfs['ref']
+    vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2,3))
+    vectorizer.fit(list(name1_df['name']))
+    name1_X = normalize(vectorizer.transform(name1_df['name']))
+
+    rows = []
+    for source in ['osm', 'mot']:
+        name2_df = name_dfs[source]
+        name2_X = normalize(vectorizer.transform(name2_df['name']))
+
+        for cutoff in cutoffs:
+            i, j, name_sim_cs = peak.candidate_pairs(
+                name1_X, name2_X, top_k=len(name2_df), cutoff=cutoff)
+            logger.info('scoring {} {} candidates at cutoff {}'
+                        .format(len(i), source, cutoff))
+
+            loop_df = loop_score(name1_df, name2_df, i, j, name_sim_cs)
+            pd.testing.assert_frame_equal(
+                loop_df, peak.score_pairs(name1_df, name2_df, i, j,
+                                          name_sim_cs))
+
+            for case, score in [
+                    ('loop'      , lambda: loop_score(name1_df, name2_df,
+                                                      i, j, name_sim_cs)),
+                    ('vectorized', lambda: peak.score_pairs(name1_df,
+                                                            name2_df, i, j,
+                                                            name_sim_cs))]:
+                seconds = np.median(time_call(score, repeat, warmup=0))
+                rows.append(['{} {}'.format(source, case), cutoff, len(i),
+                             '{:.4f}'.format(seconds),
+                             '{:.0f}'.format(len(i)/seconds)])
+
+    report(rows, ['case', 'cutoff', 'pairs', 'seconds', 'pairs_per_s'])
+
+
+def bench_predict(repeat=200):
+    '''Compare the array-backed prediction engine against the original
+    DataFrame copy-and-assign prediction path'''
+    from .web import app
+    from .web.engine import PEAK_COLS, peak_dataframe
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    logger.info('loading assets')
+    assets = app.load_assets()
+
+    peak_df = utils.data_matrix(peak_dataframe(assets.peak_geojson,
+                                               app.DEFAULTS))
+    exped_data = app.expedition_data({'age': 45, 'o2_used': 'Y'})
+
+    def dataframe_predict():
+        exped_df = peak_df.copy(deep=True)
+        utils.update_data_matrix(exped_df, data=exped_data,
+                                 ignore_cols=PEAK_COLS)
+        return assets.model.predict_proba(exped_df)[:, 1]
+
+    def engine_predict():
+        return assets.engine.predict_proba(exped_data)
+
+    if not np.allclose(dataframe_predict(), engine_predict()):
+        raise AssertionError('engine and dataframe predictions differ')
+
+    logger.info('timing {} predictions per case'.format(repeat))
+    report([
+        latency_row('dataframe', time_call(dataframe_predict, repeat)),
+        latency_row('engine'   , time_call(engine_predict   , repeat))
+    ], LATENCY_HEADERS)
+
+
+def bench_artifact(repeat=20):
+    '''Compare the size and load time of the model pickle against the
+    compact memory-mapped model artifact'''
+    import joblib
+    import os
+    from .artifact import convert_model, load_artifact
+    from .web import app
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    logger.info('loading assets')
+    app.app.config['MODEL_STORE'] = None
+    app.app.config['MODEL_ARTIFACT'] = None
+    assets = app.load_assets()
+
+    X = assets.engine.batch_matrix([app.expedition_data({})])
+
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        artifact_path = Path(temp_dir) / 'rfmodel.artifact'
+
+        logger.info('converting model pickle')
+        convert_model(assets.model_path, artifact_path)
+
+        forest, _ = load_artifact(artifact_path)
+        error = np.abs(assets.engine.score(X) - forest.predict_proba(X)[:, 1])
+        logger.info('largest probability difference {:.2e}'
+                    .format(error.max()))
+
+        for case, path, load in [
+                ('pickle'  , assets.model_path, joblib.load  ),
+                ('artifact', artifact_path    , load_artifact)]:
+            times = time_call(lambda: load(path), repeat, warmup=1)
+            rows.append([case, '{:.1f}'.format(os.path.getsize(path)/1024),
+                         '{:.3f}'.format(1000*np.median(times))])
+
+    report(rows, ['case', 'size_kb', 'load_ms'])
+
+
+def bench_collapse(repeat=3):
+    '''Compare fitting the forest on every training row against fitting it
+    on the unique rows weighted by their counts'''
+    from . import rfmodel
+    from sklearn.ensemble import RandomForestClassifier
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    matrix, _ = rfmodel.load_matrix()
+    X, y = np.asarray(matrix['X']), np.asarray(matrix['y'])
+
+    start = perf_counter()
+    X_unique, y_unique, weight = rfmodel.collapse_rows(X, y)
+    collapse_s = perf_counter() - start
+
+    logger.info('collapsed {} rows to {} in {:.3f}s'
+                .format(X.shape[0], X_unique.shape[0], collapse_s))
+
+    # Without bootstrapping or feature sampling, the weighted and unweighted
+    # fits must grow identical trees
+    exact_params = {**rfmodel.RF_PARAMS, 'bootstrap': False,
+                    'max_features': None, 'random_state': 0}
+    full = RandomForestClassifier(**exact_params).fit(X, y)
+    weighted = RandomForestClassifier(**exact_params).fit(
+        X_unique, y_unique, sample_weight=weight)
+    if not np.array_equal(full.predict_proba(X), weighted.predict_proba(X)):
+        raise AssertionError('weighted and full forests differ')
+
+    rows = []
+    for case, X_fit, y_fit, weight_fit in [
+            ('full'     , X       , y       , None  ),
+            ('collapsed', X_unique, y_unique, weight)]:
+        times = []
+        scores = []
+        for _ in range(repeat):
+            start = perf_counter()
+            rf_model = rfmodel.train_model(X_fit, y_fit,
+                                           sample_weight=weight_fit)
+            times.append(perf_counter() - start)
+            scores.append(rfmodel.oob_score(rf_model, y_fit, weight_fit))
+
+        rows.append([case, X_fit.shape[0], '{:.3f}'.format(np.mean(times)),
+                     '{:.4f}'.format(np.mean(scores))])
+
+    report(rows, ['case', 'rows', 'fit_s', 'oob_score'])
+
+
+def bench_encoder(scales=(1, 10, 100)):
+    '''Compare the column-by-column DataFrame encoding of model_base against
+    the compiled schema encoder at multiples of the database row count'''
+    import pandas as pd
+    from . import rfmodel
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    logger.info('retrieving data')
+    base_df = rfmodel.get_data()
+    encoder = utils.SchemaEncoder()
+
+    def dataframe_encode(data_df):
+        model_df = pd.DataFrame(index=data_df.index.copy(deep=True))
+        return utils.update_data_matrix(model_df, data_df)
+
+    rows = []
+    for scale in scales:
+        data_df = base_df.iloc[np.tile(np.arange(len(base_df)), scale)]
+        logger.info('encoding {} rows'.format(len(data_df)))
+
+        # One repeat at the larger scales, where a single encoding takes
+        # seconds
+        repeat = max(1, 10 // scale)
+        for case, encode in [('dataframe', dataframe_encode),
+                             ('frame'    , encoder.frame   ),
+                             ('encode'   , encoder.encode  )]:
+            times = time_call(lambda: encode(data_df), repeat, warmup=0)
+            rows.append([case, len(data_df),
+                         '{:.3f}'.format(np.median(times))])
+
+        del data_df
+
+    report(rows, ['case', 'rows', 'seconds'])
+
+
+def _encode_memory(mode, database_path, results):
+    import pandas as pd
+    import resource
+    from . import rfmodel
+
+    start = perf_counter()
+    if mode == 'dataframe':
+        data_df = rfmodel.get_data(database_path)
+        utils.SchemaEncoder().encode(data_df)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rfmodel.write_matrix(Path(temp_dir) / 'matrix', 'stream',
+                                 database_path)
+    seconds = perf_counter() - start
+
+    # Peak resident set size, in kB on Linux
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF)
+                                  .ru_maxrss/1024))
+
+
+def bench_stream(scales=(1, 10)):
+    '''Compare the peak memory of encoding model_base read whole into a
+    DataFrame against streaming it in chunks into memory-mapped arrays, on
+    copies of the database repeated to multiples of its size'''
+    import sqlite3
+    from . import DATABASE_PATH
+
+    logger = logging.getLogger('mahalangur.benchmark')
+    context = mp.get_context('spawn')
+
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scale in scales:
+            database_path = Path(temp_dir) / 'model_base_x{}.db'.format(scale)
+
+            logger.info('writing {}x model_base'.format(scale))
+            conn = sqlite3.connect(database_path)
+            conn.execute('ATTACH DATABASE ? AS source', (str(DATABASE_PATH),))
+            conn.execute('CREATE TABLE model_base AS '
+                         'SELECT * FROM source.model_base')
+            for _ in range(scale - 1):
+                conn.execute('INSERT INTO model_base '
+                             'SELECT * FROM source.model_base')
+            conn.commit()
+            n_rows, = conn.execute('SELECT COUNT(*) FROM model_base')\
+                          .fetchone()
+            conn.close()
+
+            for mode in ['dataframe', 'stream']:
+                results = context.Queue()
+                worker = context.Process(target=_encode_memory,
+                                         args=(mode, database_path, results))
+                worker.start()
+                seconds, peak_mb = results.get()
+                worker.join()
+
+                rows.append([mode, n_rows, '{:.2f}'.format(seconds),
+                             '{:.1f}'.format(peak_mb)])
+
+            database_path.unlink()
+
+    report(rows, ['case', 'rows', 'seconds', 'peak_rss_mb'])
+
+
+def bench_forest(batch_sizes=(1, 10, 100, 1000, 10000, 100000)):
+    '''Compare the latency of the compiled forest against sklearn's
+    predict_proba across batch sizes'''
+    from .forest import check_forest, compile_forest
+    from .web import app
+
+    logger = logging.getLogger('mahalangur.benchmark')
+
+    logger.info('loading assets')
+    app.app.config['MODEL_STORE'] = None
+    app.app.config['MODEL_ARTIFACT'] = None
+    assets = app.load_assets()
+
+    forest = compile_forest(assets.model)
+
+    # Random expedition profiles stacked against every peak
+    rng = np.random.default_rng(0)
+    n_profiles = -(-max(batch_sizes) // len(assets.engine.peak_ids))
+    profiles = [{
+        'expedition_year' : int(rng.integers(1970, 2030)),
+        'season'          : str(rng.choice(['Spring', 'Summer', 'Autumn',
+                                            'Winter'])),
+        'commercial_route': str(rng.choice(['N', 'Y'])),
+        'total_members'   : int(rng.integers(1, 25)),
+        'total_hired'     : int(rng.integers(0, 15)),
+        'age'             : int(rng.integers(16, 65)),
+        'sex'             : str(rng.choice(['M', 'F'])),
+        'o2_used'         : str(rng.choice(['N', 'Y']))
+    } for _ in range(n_profiles)]
+
+    X = assets.engine.batch_matrix(profiles)
+    X = X[rng.permutation(X.shape[0])]
+
+    logger.info('checking equivalence on {} rows'.format(X.shape[0]))
+    check_forest(assets.model, forest, X)
+
+    rows = []
+    for batch_size in batch_sizes:
+        X_batch = X[:batch_size]
+        repeat = max(5, min(200, 20000 // batch_size))
+
+        for case, model in [('sklearn', assets.model),
+                            ('compiled', forest)]:
+            times = time_call(lambda: model.predict_proba(X_batch), repeat)
+            rows.append(latency_row('{} x{}'.format(case, batch_size), times))
+
+    report(rows, LATENCY_HEADERS)
+
+
+def _worker_memory(model_store, barrier, results):
+    from .web import app
+
+    start = perf_counter()
+    app.app.config['MODEL_STORE'] = model_store
+    app.app.config['MODEL_ARTIFACT'] = None
+    app.load_assets()
+    app.predict(app.expedition_data({}))
+    load_time = perf_counter() - start
+
+    # Measure while every worker is alive so shared pages are split between
+    # them in the proportional set size
+    barrier.wait()
+    results.put((load_time, process_memory()))
+    barrier.wait()
+
+
+def bench_workers(n_workers=4):
+    '''Compare the start-up time and memory of worker processes that each
+    unpickle the model against workers that memory-map a shared store'''
+    from .web import app, store
+
+    logger = logging.getLogger('mahalangur.benchmark')
+    context = mp.get_context('spawn')
+
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store_dir = Path(temp_dir)
+
+        logger.info('exporting model store')
+        app.app.config['MODEL_STORE'] = None
+        app.app.config['MODEL_ARTIFACT'] = None
+        assets = app.load_assets()
+        store.export_store(assets.model, assets.engine, assets.model_sha256,
+                           store_dir=store_dir, payloads=assets.payloads)
+
+        for case, model_store in [('pickle', None),
+                                  ('store' , str(store_dir))]:
+            logger.info('starting {} {} workers'.format(n_workers, case))
+
+            barrier = context.Barrier(n_workers)
+            results = context.Queue()
+            workers = [context.Process(target=_worker_memory,
+                                       args=(model_store, barrier, results))
+                       for _ in range(n_workers)]
+            for worker in workers:
+                worker.start()
+
+            measures = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+            load_ms = 1000*np.mean([load_time for load_time, _ in measures])
+            memory = {key: np.mean([mem[key] for _, mem in measures])
+                      for key in ['rss', 'pss', 'uss']}
+
+            rows.append([case, n_workers, '{:.1f}'.format(load_ms),
+                         '{:.1f}'.format(memory['rss']),
+                         '{:.1f}'.format(memory['pss']),
+                         '{:.1f}'.format(memory['uss'])])
+
+    report(rows, ['case', 'workers', 'load_ms', 'rss_mb', 'pss_mb', 'uss_mb'])
+
+
+BENCHMARKS = {
+    'artifact': bench_artifact,
+    'collapse': bench_collapse,
+    'encoder' : bench_encoder,
+    'forest'  : bench_forest,
+    'match'   : bench_match,
+    'predict' : bench_predict,
+    'stream'  : bench_stream,
+    'workers' : bench_workers
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    parser = argparse.ArgumentParser(description='Mahalangur benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark]()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import csv
+import hashlib
 import logging
 import sqlite3
 import socket
@@ -101,6 +102,18 @@ def download_file(url, file_path, chunk_size=1024*1024, timeout=5.0,
     return file_path
 
 
+### Functions - files
+
+def sha256_file(file_path, chunk_size=1024*1024):
+    '''Hex digest of the SHA-256 hash of a file's contents'''
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
 ### Functions - delimited files
 
 def open_dsv(dsv_path, mode='r'):
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import numpy as np
+from collections import defaultdict
+from shapely.geometry import Point, Polygon
+from shapely.prepared import prep
+
+
+### Logic
+
+def read_himals(geojson_path):
+    '''Read the himal polygons into a {himal_id: himal_poly} dictionary'''
+    with open(geojson_path, 'r') as geojson_file:
+        features = json.load(geojson_file)['features']
+
+    black_list = set()
+    for feature in features:
+        parent = feature.get('properties', {}).get('parent')
+        if parent is not None:
+            black_list.add(parent)
+
+    himals = {}
+    for feature in features:
+        himal_id = feature['id']
+        if himal_id not in black_list:
+            himals[himal_id] = Polygon(feature['geometry']['coordinates'][0])
+
+    return himals
+
+
+class HimalLocator:
+    '''Grid index of himal bounding boxes for locating the himal of a point.
+    Each polygon is prepared once, and a point is only tested against the
+    polygons whose bounding box covers it. When polygons overlap, the first
+    himal in the order of himals wins.'''
+
+    def __init__(self, himals, cell_size=0.5):
+        self.cell_size = cell_size
+
+        self.himal_ids = list(himals)
+        self.polygons  = [prep(polygon) for polygon in himals.values()]
+
+        # (min_lon, min_lat, max_lon, max_lat) of each himal
+        self.bounds = np.array([polygon.bounds for polygon in himals.values()],
+                               dtype=np.float64).reshape(-1, 4)
+
+        # Himals, in order, whose bounding box overlaps each grid cell
+        cells = defaultdict(list)
+        for k, (min_lon, min_lat, max_lon, max_lat) in enumerate(self.bounds):
+            min_x, min_y = self.cell(min_lon, min_lat)
+            max_x, max_y = self.cell(max_lon, max_lat)
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    cells[(x, y)].append(k)
+
+        self.cells = dict(cells)
+
+    @classmethod
+    def from_geojson(cls, geojson_path, **kwargs):
+        return cls(read_himals(geojson_path), **kwargs)
+
+    def cell(self, lon, lat):
+        return (math.floor(lon / self.cell_size),
+                math.floor(lat / self.cell_size))
+
+    def locate(self, lon, lat):
+        '''Himal id of the point, or None if it is outside every himal'''
+        return self.locate_many([lon], [lat])[0]
+
+    def locate_many(self, lon, lat):
+        '''Himal ids of each point of the lon and lat arrays as an object
+        array, with None for points outside every himal or without
+        coordinates'''
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+
+        himals = np.full(lon.shape, None, dtype=object)
+
+        # Group the points by grid cell, so each cell's himals are looked up
+        # once
+        points = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+        cell_x = np.floor(lon[points] / self.cell_size).astype(np.int64)
+        cell_y = np.floor(lat[points] / self.cell_size).astype(np.int64)
+        cell_xy, cell_codes = np.unique(np.stack([cell_x, cell_y], axis=1),
+                                        axis=0, return_inverse=True)
+        cell_codes = cell_codes.reshape(-1)
+
+        for code, (x, y) in enumerate(cell_xy):
+            candidates = self.cells.get((int(x), int(y)))
+            if candidates is None:
+                continue
+
+            unassigned = points[cell_codes == code]
+            for k in candidates:
+                min_lon, min_lat, max_lon, max_lat = self.bounds[k]
+                point_lon = lon[unassigned]
+                point_lat = lat[unassigned]
+                in_bounds = ((min_lon <= point_lon) & (point_lon <= max_lon) &
+                             (min_lat <= point_lat) & (point_lat <= max_lat))
+
+                polygon = self.polygons[k]
+                inside = np.zeros(len(unassigned), dtype=bool)
+                for i in np.flatnonzero(in_bounds):
+                    inside[i] = polygon.contains(Point(point_lon[i],
+                                                       point_lat[i]))
+
+                himals[unassigned[inside]] = self.himal_ids[k]
+                unassigned = unassigned[~inside]
+                if len(unassigned) == 0:
+                    break
+
+        return himals
@@ -1,22 +1,35 @@
 # -*- coding: utf-8 -*-
+import argparse
 import copy
 import importlib.resources as res
 import json
 import logging
+import multiprocessing as mp
+import numpy as np
+import os
 import pandas as pd
 import re
 from .. import DATA_DIR, LOG_FORMAT, METADATA_DIR
 from ..data import utils
+from ..data.utils import sha256_file
+from .himal import HimalLocator, read_himals
 from Levenshtein import jaro_winkler
-from shapely.geometry import Point, Polygon
-from sklearn.metrics.pairwise import cosine_similarity
+from hashlib import sha256
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.neighbors import BallTree
+from sklearn.preprocessing import normalize
 
 
 ### Globals
 HDB_DSV_PATH       = (DATA_DIR / 'processed' / 'hdb_peak.txt').resolve()
 PEAK_GEOJSON_PATH  = (METADATA_DIR / 'web_peak.geojson').resolve()
 PEAK_DSV_PATH      = (METADATA_DIR / 'ref_peak.txt'    ).resolve()
+MATCH_CACHE_PATH   = (METADATA_DIR / 'peak_match.json' ).resolve()
+
+# Per-peak matches are reused by later builds while their inputs and the
+# cache version are unchanged
+MATCH_CACHE_VERSION = 2
 
 SUBSTITUTIONS = {
     r'(?<=\W)KANG'       : 'KHANG',
@@ -29,6 +42,37 @@ TITLES = {'NORTH', 'WEST', 'EAST', 'SOUTH', 'CENTRAL', 'MIDDLE', 'I', 'II',
 
 IGNORE_WORDS = {'HIMAL', 'PEAK'}
 
+# Candidate names kept per name, the least cosine similarity of their
+# character n-grams, and the names compared at a time when matching
+MATCH_TOP_K      = 20
+MATCH_CUTOFF     = 0.5
+MATCH_BLOCK_SIZE = 1024
+
+MATCH_HEADERS = [
+    'id',
+    'seq',
+    'full_name',
+    'name',
+    'title',
+    'match_id',
+    'match_seq',
+    'match_full_name',
+    'match_name',
+    'match_title',
+    'name_similarity_cs',
+    'name_similarity_jw',
+    'title_similarity',
+    'similarity'
+]
+
+# Peaks further apart than LINK_RADIUS_KM are not linked when linking by
+# coordinates
+LINK_RADIUS_KM  = 10
+EARTH_RADIUS_KM = 6371.0088
+
+# Unique name pairs per task when scoring candidates in a process pool
+SCORE_CHUNK_SIZE = 20000
+
 # 0.7 override
 MOTCA_OVERRIDE = {
     'RANI': '119', # Himalchuli Northeast = Himalchuli East?
@@ -79,26 +123,6 @@ def read_peaks(dsv_path, id_col):
     return peaks
 
 
-def read_himals(geojson_path):
-    '''Read the himal polygons into a {himal_id: himal_poly} dictionary'''
-    with open(geojson_path, 'r') as geojson_file:
-        features = json.load(geojson_file)['features']
-    
-    black_list = set()
-    for feature in features:
-        parent = feature.get('properties', {}).get('parent')
-        if parent is not None:
-            black_list.add(parent)
-
-    himals = {}
-    for feature in features:
-        himal_id = feature['id']
-        if himal_id not in black_list:
-            himals[himal_id] = Polygon(feature['geometry']['coordinates'][0])
-
-    return himals
-
-
 def process_name(name):
     '''Preprocesses a name by subsituting non-alphanumeric characters with
     whitespace, substituting several patterns and filtering some common words
@@ -172,80 +196,266 @@ def choose_match(match_df):
     })
 
 
-def match_names(name1_df, name2_df, reduce=True):
-    name_vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2,3))
-    name_vectorizer.fit(list(name1_df['name']))
+def top_candidates(i, j, sim, top_k, cutoff):
+    '''Keep the pairs with a similarity of at least cutoff, and of those the
+    top_k most similar of each i'''
+    keep = sim >= cutoff
+    i, j, sim = i[keep], j[keep], sim[keep]
+
+    # Rank the candidates of each name by descending similarity and keep the
+    # first top_k
+    order = np.lexsort((-sim, i))
+    i, j, sim = i[order], j[order], sim[order]
+
+    row_starts = np.searchsorted(i, i, side='left')
+    keep = np.arange(len(i)) - row_starts < top_k
+
+    return i[keep], j[keep], sim[keep]
+
+
+def offset_features(X, rows, groups, n_features):
+    '''The rows of X with the features of each row moved to the feature
+    space of its group'''
+    X = X[rows]
+    indices = X.indices + np.repeat(groups*n_features, np.diff(X.indptr))
+
+    return csr_matrix((X.data, indices, X.indptr),
+                      shape=(X.shape[0], (groups.max() + 1)*n_features))
+
+
+def grouped_similarity(name1_X, name2_X, groups):
+    '''Similarities of the rows of name1_X and the rows of name2_X of each
+    (rows1, rows2) group, as (i, j, similarity) arrays. Every group's
+    features are offset into a feature space of its own, so a single sparse
+    product compares the names within each group and no others.'''
+    n_features = name1_X.shape[1]
+    rows1 = np.concatenate([rows1 for rows1, _ in groups])
+    rows2 = np.concatenate([rows2 for _, rows2 in groups])
+    groups1 = np.repeat(np.arange(len(groups)),
+                        [len(rows1) for rows1, _ in groups])
+    groups2 = np.repeat(np.arange(len(groups)),
+                        [len(rows2) for _, rows2 in groups])
+
+    product = (offset_features(name1_X, rows1, groups1, n_features) @
+               offset_features(name2_X, rows2, groups2, n_features).T)
+    product = product.tocoo()
+
+    return rows1[product.row], rows2[product.col], product.data
+
+
+def candidate_pairs(name1_X, name2_X, top_k=MATCH_TOP_K,
+                    cutoff=MATCH_CUTOFF, block_size=MATCH_BLOCK_SIZE,
+                    allowed=None):
+    '''Find the top_k most similar names of name2_X for each name of name1_X
+    with a cosine similarity of at least cutoff. The rows of both matrices
+    must be L2 normalized. Similarities are computed as sparse products of
+    blocks of rows, so memory is bounded by the block size rather than the
+    number of name pairs. Returns (i, j, similarity) arrays ordered by i and
+    j.
+
+    If given, allowed restricts the candidates of each name of name1_X to an
+    array of rows of name2_X, or to any row where it is None. Only the
+    allowed pairs of restricted names are compared.'''
+    n_names1 = name1_X.shape[0]
+
+    unrestricted = np.arange(n_names1)
+    if allowed is not None:
+        unrestricted = np.array([k for k, rows in enumerate(allowed)
+                                 if rows is None], dtype=np.int64)
+
+    pairs = []
+
+    # Names compared with every name of name2_X
+    name2_XT = name2_X.T.tocsr()
+    for start in range(0, len(unrestricted), block_size):
+        block_rows = unrestricted[start:start+block_size]
+        block = (name1_X[block_rows] @ name2_XT).tocoo()
+
+        i, j, sim = top_candidates(block.row, block.col, block.data,
+                                   top_k, cutoff)
+        pairs.append((block_rows[i], j, sim))
+
+    # Names compared with their allowed names only, grouping the names with
+    # the same allowed names
+    if allowed is not None:
+        grouped = {}
+        for k, rows in enumerate(allowed):
+            if rows is not None and len(rows) > 0:
+                rows = np.asarray(rows, dtype=np.int64)
+                grouped.setdefault(rows.tobytes(), (rows, []))[1].append(k)
+
+        groups = [(np.array(rows1, dtype=np.int64), rows2)
+                  for rows2, rows1 in grouped.values()]
+
+        # As many groups per product as the pairs of a block of names
+        # compared with every name
+        max_pairs = block_size*name2_X.shape[0]
+        chunk = []
+        n_pairs = 0
+        for k, (rows1, rows2) in enumerate(groups):
+            chunk.append((rows1, rows2))
+            n_pairs += len(rows1)*len(rows2)
+            if n_pairs >= max_pairs or k == len(groups) - 1:
+                i, j, sim = grouped_similarity(name1_X, name2_X, chunk)
+                pairs.append(top_candidates(i, j, sim, top_k, cutoff))
+                chunk = []
+                n_pairs = 0
+
+    empty = np.empty(0, dtype=np.int64)
+    i = np.concatenate([empty] + [i for i, _, _ in pairs])
+    j = np.concatenate([empty] + [j for _, j, _ in pairs])
+    sim = np.concatenate([np.empty(0)] + [sim for _, _, sim in pairs])
+
+    order = np.lexsort((j, i))
+    return i[order], j[order], sim[order]
+
+
+def _jaro_winkler_pairs(pairs):
+    return [jaro_winkler(name1, name2, 0.1) for name1, name2 in pairs]
+
+
+def unique_pairs(values1, values2):
+    '''Codes of each (values1, values2) pair and the list of unique pairs'''
+    # A MultiIndex cannot be built from empty arrays
+    if len(values1) == 0:
+        return np.empty(0, dtype=np.intp), []
+
+    codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([values1,
+                                                             values2]))
+    return codes, list(uniques)
+
+
+def jaro_winkler_pairs(names1, names2, n_jobs=1,
+                       chunk_size=SCORE_CHUNK_SIZE):
+    '''Jaro-Winkler similarity of each pair of names1 and names2, computed
+    once per unique pair, serially by default. With an n_jobs other than
+    1, more than chunk_size unique pairs are split into chunks scored in a
+    pool of n_jobs processes, or of all cores if n_jobs is None.'''
+    codes, pairs = unique_pairs(names1, names2)
+
+    if n_jobs == 1 or len(pairs) <= chunk_size:
+        similarity = _jaro_winkler_pairs(pairs)
+    else:
+        chunks = [pairs[start:start+chunk_size]
+                  for start in range(0, len(pairs), chunk_size)]
+        with mp.Pool(n_jobs) as pool:
+            similarity = [sim for chunk in pool.map(_jaro_winkler_pairs,
+                                                    chunks)
+                          for sim in chunk]
+
+    return np.array(similarity, dtype=np.float64)[codes]
+
+
+def jaccard_pairs(titles1, titles2):
+    '''Jaccard similarity of the words of each pair of titles1 and titles2,
+    computed once per unique pair'''
+    codes, pairs = unique_pairs(titles1, titles2)
+
+    similarity = [jaccard(title1.split(), title2.split())
+                  for title1, title2 in pairs]
+
+    return np.array(similarity, dtype=np.float64)[codes]
+
+
+def score_pairs(name1_df, name2_df, i, j, name_sim_cs, n_jobs=1):
+    '''Score the candidate pairs of rows i of name1_df and j of name2_df,
+    blending the name and title similarities'''
+    columns = ['id', 'seq', 'full_name', 'name', 'title']
+    values1 = {col: name1_df[col].to_numpy()[i] for col in columns}
+    values2 = {col: name2_df[col].to_numpy()[j] for col in columns}
+
+    # Similarity between names
+    name_sim_jw = jaro_winkler_pairs(values1['name'], values2['name'],
+                                     n_jobs=n_jobs)
+
+    similarity = (name_sim_cs + name_sim_jw)/2
+
+    # Similarity between titles, weighted by the number of words in the
+    # title of name1 up to two. Names without a title have a zero weight.
+    title_sim = jaccard_pairs(values1['title'], values2['title'])
+
+    n_titles = np.array([len(title.split()) for title in name1_df['title']],
+                        dtype=np.int64)
+    title_weight = np.minimum(n_titles[i], 2)*0.1
+
+    similarity = title_weight*title_sim + (1-title_weight)*similarity
+
+    return pd.DataFrame(columns=MATCH_HEADERS, data={
+        'id'                : values1['id'],
+        'seq'               : values1['seq'],
+        'full_name'         : values1['full_name'],
+        'name'              : values1['name'],
+        'title'             : values1['title'],
+        'match_id'          : values2['id'],
+        'match_seq'         : values2['seq'],
+        'match_full_name'   : values2['full_name'],
+        'match_name'        : values2['name'],
+        'match_title'       : values2['title'],
+        'name_similarity_cs': name_sim_cs,
+        'name_similarity_jw': name_sim_jw,
+        'title_similarity'  : title_sim,
+        'similarity'        : similarity
+    })
 
-    name1_X = name_vectorizer.transform(name1_df['name'])
-    name2_X = name_vectorizer.transform(name2_df['name'])
 
-    similarity_matrix = cosine_similarity(name1_X, name2_X)
+def fit_vectorizer(fit_names):
+    '''TF-IDF vectorizer of the character bigrams and trigrams of the names
+    fit_names'''
+    name_vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2,3))
+    name_vectorizer.fit(list(fit_names))
 
-    matches = []
-    for i, j in zip(*similarity_matrix.nonzero()):
-            # Similarity between names
-            name_sim_cs = similarity_matrix[i, j]
+    return name_vectorizer
 
-            if name_sim_cs < 0.5: continue
 
-            match1 = name1_df.iloc[i]
-            match2 = name2_df.iloc[j]
+def vectorizer_weights(name_vectorizer):
+    '''{ngram: idf} dictionary of the weights of a fitted vectorizer'''
+    idf = name_vectorizer.idf_
+    return {ngram: float(idf[k])
+            for ngram, k in sorted(name_vectorizer.vocabulary_.items())}
 
-            name1 = match1['name']
-            name2 = match2['name']
 
-            name_sim_jw = jaro_winkler(name1, name2, 0.1)
+def weighted_vectorizer(weights):
+    '''TF-IDF vectorizer with the {ngram: idf} weights of an earlier fit'''
+    ngrams = sorted(weights)
 
-            similarity = (name_sim_cs + name_sim_jw)/2
+    name_vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2,3),
+                                      vocabulary=ngrams)
+    name_vectorizer.idf_ = np.array([weights[ngram] for ngram in ngrams],
+                                    dtype=np.float64)
 
-            # Similarity between titles
+    return name_vectorizer
 
-            title1 = match1['title']
-            title2 = match2['title']
 
-            titles = title1.split()
-            title_sim = jaccard(titles, title2.split())
-            if title1 != '':
-                title_weight = min(len(titles), 2)*0.1
+def match_names(name1_df, name2_df, reduce=True, top_k=MATCH_TOP_K,
+                cutoff=MATCH_CUTOFF, n_jobs=1, candidates=None,
+                name_vectorizer=None):
+    '''Match each name of name1_df to the names of name2_df. candidates
+    optionally restricts the matches of a name1 id to a collection of
+    name2 ids, for instance the peaks near it. The names are weighted with
+    name_vectorizer, by default fit on the names of name1_df.'''
+    if name_vectorizer is None:
+        name_vectorizer = fit_vectorizer(name1_df['name'])
 
-                similarity = (title_weight*title_sim +
-                              (1-title_weight)*similarity)
+    # Normalized again as cosine_similarity does, so that the similarities
+    # of identical names are exactly one
+    name1_X = normalize(name_vectorizer.transform(name1_df['name']))
+    name2_X = normalize(name_vectorizer.transform(name2_df['name']))
 
-            matches.append([
-                match1['id'],
-                match1['seq'],
-                match1['full_name'],
-                name1,
-                title1,
-                match2['id'],
-                match2['seq'],
-                match2['full_name'],
-                name2,
-                title2,
-                name_sim_cs,
-                name_sim_jw,
-                title_sim,
-                similarity
-            ])
+    allowed = None
+    if candidates is not None:
+        rows2 = name2_df.groupby('id').indices
+        empty = np.empty(0, dtype=np.int64)
+        allowed = [None if id1 not in candidates else
+                   np.concatenate([empty] + [rows2[id2]
+                                             for id2 in candidates[id1]
+                                             if id2 in rows2])
+                   for id1 in name1_df['id']]
 
-    headers = [
-        'id',
-        'seq',
-        'full_name',
-        'name',
-        'title',
-        'match_id',
-        'match_seq',
-        'match_full_name',
-        'match_name',
-        'match_title',
-        'name_similarity_cs',
-        'name_similarity_jw',
-        'title_similarity',
-        'similarity'
-    ]
+    i, j, name_sim_cs = candidate_pairs(name1_X, name2_X, top_k=top_k,
+                                        cutoff=cutoff, allowed=allowed)
 
-    match_df = pd.DataFrame(data=matches, columns=headers)
+    match_df = score_pairs(name1_df, name2_df, i, j, name_sim_cs,
+                           n_jobs=n_jobs)
 
     if reduce:
         return match_df.groupby(['id']).apply(choose_match)
@@ -253,17 +463,168 @@ def match_names(name1_df, name2_df, reduce=True):
         return match_df
 
 
-def name_link(name1_df, name2_df, override={}, threshold=0.6):
-    matches_df = match_names(name1_df, name2_df, reduce=True)
+def nearby_peaks(coords, peaks, radius_km=LINK_RADIUS_KM, locator=None,
+                 himal_override={}):
+    '''Candidate peaks for linking: a {peak_id: {id, ...}} dictionary of
+    the peaks within radius_km of each (lon, lat) of coords, by haversine
+    distance. Given a himal locator, the peaks in the same himal as each
+    coordinate, or as its himal_override, are candidates too, since some
+    peak coordinates are approximate. Peaks without coordinates are left
+    out, so their candidates are not restricted.'''
+    peak_ids = [peak_id for peak_id, peak in peaks.items()
+                if peak.get('longitude') and peak.get('latitude')]
+    lon = np.array([float(peaks[peak_id]['longitude'])
+                    for peak_id in peak_ids])
+    lat = np.array([float(peaks[peak_id]['latitude'])
+                    for peak_id in peak_ids])
+    peak_ids = np.array(peak_ids, dtype=object)
+
+    candidates = {peak_id: set() for peak_id in coords}
+    if coords and len(peak_ids) > 0:
+        tree = BallTree(np.radians(np.stack([lat, lon], axis=1)),
+                        metric='haversine')
+
+        coord_ids = list(coords)
+        coord_lon, coord_lat = np.array([coords[peak_id]
+                                         for peak_id in coord_ids]).T
+        near = tree.query_radius(
+            np.radians(np.stack([coord_lat, coord_lon], axis=1)),
+            r=radius_km/EARTH_RADIUS_KM)
+
+        for peak_id, rows in zip(coord_ids, near):
+            candidates[peak_id].update(peak_ids[rows])
+
+    if locator is not None:
+        peak_himals = pd.Series(peak_ids).groupby(
+            locator.locate_many(lon, lat)).agg(set).to_dict()
+
+        coord_himals = dict(zip(coords, locator.locate_many(
+            [coord[0] for coord in coords.values()],
+            [coord[1] for coord in coords.values()])))
+
+        for peak_id, himal in coord_himals.items():
+            himal = himal_override.get(peak_id, himal)
+            if himal is not None:
+                candidates[peak_id].update(peak_himals.get(himal, set()))
+
+    return candidates
+
 
+def name_link(name1_df, name2_df, override={}, threshold=0.6,
+              candidates=None, n_jobs=1):
+    matches_df = match_names(name1_df, name2_df, reduce=True,
+                             candidates=candidates, n_jobs=n_jobs)
+
+    best_matches = {id: (match['match_id'], match['similarity'])
+                    for id, match in matches_df.iterrows()}
+
+    return link_matches(best_matches, override, threshold)
+
+
+def link_matches(best_matches, override={}, threshold=0.6):
+    '''Link each id to its best (match_id, similarity) match, if similar
+    enough, unless it is overridden'''
     matches = copy.deepcopy(override)
-    for id, match in matches_df.iterrows():
-        if id not in matches and match['similarity'] >= threshold:
-            matches[id] = match['match_id']
+    for id, match in best_matches.items():
+        if id not in matches and match is not None and match[1] >= threshold:
+            matches[id] = match[0]
 
     return matches
 
 
+def peak_keys(name_df, extras={}):
+    '''Hash of the processed names and titles of each peak of name_df and
+    of its extra inputs, such as overrides and coordinates'''
+    keys = {}
+    for peak_id, peak_df in name_df.groupby('id', sort=False):
+        key = json.dumps([peak_df[['seq', 'name', 'title']].values.tolist(),
+                          extras.get(peak_id)])
+        keys[peak_id] = sha256(key.encode('utf-8')).hexdigest()
+
+    return keys
+
+
+def match_context(*file_hashes, **params):
+    '''Hash of the file hashes and parameters that every match depends
+    on'''
+    context = json.dumps({
+        'files'  : file_hashes,
+        'params' : params,
+        'top_k'  : MATCH_TOP_K,
+        'cutoff' : MATCH_CUTOFF,
+        'version': MATCH_CACHE_VERSION
+    }, sort_keys=True)
+
+    return sha256(context.encode('utf-8')).hexdigest()
+
+
+def cached_matches(name1_df, name2_df, cache, context, extras={},
+                   candidates=None, n_jobs=1):
+    '''Best (match_id, similarity) match of each peak of name1_df, or None,
+    reusing the cached match of every peak whose key is unchanged. The cache
+    is only used if its context matches. The TF-IDF weights are fit on all
+    the names of name1_df when the cache is not used, and are otherwise
+    those of the cache, so reused and rescored matches share the same
+    weights.
+
+    Returns the matches, the updated cache and the number of peaks reused.'''
+    keys = peak_keys(name1_df, extras)
+
+    if cache.get('context') == context:
+        cached = cache['peaks']
+        weights = cache['weights']
+        name_vectorizer = weighted_vectorizer(weights)
+    else:
+        cached = {}
+        name_vectorizer = fit_vectorizer(name1_df['name'])
+        weights = vectorizer_weights(name_vectorizer)
+
+    matches = {peak_id: cached[peak_id]['match'] for peak_id, key in
+               keys.items() if cached.get(peak_id, {}).get('key') == key}
+    n_reused = len(matches)
+
+    stale_df = name1_df[~name1_df['id'].isin(matches)]
+    if not stale_df.empty:
+        matches_df = match_names(stale_df, name2_df, reduce=True,
+                                 n_jobs=n_jobs, candidates=candidates,
+                                 name_vectorizer=name_vectorizer)
+
+        matches.update({peak_id: None for peak_id in stale_df['id']})
+        for peak_id, match in matches_df.iterrows():
+            matches[peak_id] = (match['match_id'], float(match['similarity']))
+
+    cache = {
+        'context': context,
+        'weights': weights,
+        'peaks'  : {peak_id: {'key': key, 'match': matches[peak_id]}
+                    for peak_id, key in keys.items()}
+    }
+
+    return matches, cache, n_reused
+
+
+def read_match_cache(cache_path=MATCH_CACHE_PATH):
+    if not cache_path.exists():
+        return {}
+
+    with open(cache_path, 'r') as cache_file:
+        cache = json.load(cache_file)
+
+    return cache if cache.get('version') == MATCH_CACHE_VERSION else {}
+
+
+def write_match_cache(cache, cache_path=MATCH_CACHE_PATH):
+    if not cache_path.parent.exists():
+        cache_path.parent.mkdir(parents=True)
+
+    temp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(temp_path, 'w') as cache_file:
+        json.dump({'version': MATCH_CACHE_VERSION, **cache}, cache_file)
+    os.replace(temp_path, cache_path)
+
+    return cache_path
+
+
 def peak_list(hdb_peaks, himals, himal_override, osm_peaks, motca_peaks):
     peaks = [[
         'peak_id',
@@ -330,14 +691,8 @@ def peak_list(hdb_peaks, himals, himal_override, osm_peaks, motca_peaks):
                 else:
                     coord_notes += '\n' + coord_note
 
-        # Get himal details
+        # Get himal details, located below for peaks without an override
         himal = himal_override.get(peak_id)
-        if himal is None and lon is not None and lat is not None:
-            peak_coord = Point(lon, lat)
-            for himal_id, himal_poly in himals.items():
-                if himal_poly.contains(peak_coord):
-                    himal = himal_id
-                    break
 
         # Peak elevation
         height = hdb_peak.get('heightm')
@@ -358,6 +713,16 @@ def peak_list(hdb_peaks, himals, himal_override, osm_peaks, motca_peaks):
             himal
         ])
 
+    # Locate the himals of every peak with coordinates in one lookup
+    if not isinstance(himals, HimalLocator):
+        himals = HimalLocator(himals)
+
+    rows = [row for row in peaks[1:] if row[11] is None and row[6] is not None]
+    located = himals.locate_many([row[6] for row in rows],
+                                 [row[7] for row in rows])
+    for row, himal in zip(rows, located):
+        row[11] = himal
+
     return peaks
 
 
@@ -391,7 +756,13 @@ def peak_geojson(peak_list):
     }
 
 
-def peak_metadata():
+def peak_metadata(spatial=False, full=False, n_jobs=1):
+    '''Link the HDB peaks to the OSM and MoTCA peaks and write the peak
+    list and geojson. With spatial, the MoTCA candidates of a peak linked to
+    OSM are restricted to the MoTCA peaks near its OSM coordinates or in the
+    same himal. Matches cached by an earlier build are reused for the peaks
+    whose inputs are unchanged, unless full. Name pairs are scored in
+    n_jobs processes.'''
     logger = logging.getLogger('mahalangur.features.peaks')
 
     # Read peaks as {id: record} dictionary
@@ -400,13 +771,16 @@ def peak_metadata():
     meta_dir = 'mahalangur.data.metadata'
     with res.path(meta_dir, 'osm_peak.txt') as osm_dsv_path:
         osm_peaks = read_peaks(osm_dsv_path, id_col='peak_id')
+        osm_sha256 = sha256_file(osm_dsv_path)
 
     with res.path(meta_dir, 'mot_peak.txt') as mot_dsv_path:
         mot_peaks = read_peaks(mot_dsv_path, id_col='peak_number')
+        mot_sha256 = sha256_file(mot_dsv_path)
 
     # Read himal geometry
     with res.path(meta_dir, 'web_himal.geojson') as himal_path:
-        himals = read_himals(himal_path)
+        himals = HimalLocator.from_geojson(himal_path)
+        himal_sha256 = sha256_file(himal_path)
 
     # Create a dataframe of names with header [id, seq, full_name, name, title]
     hdb_name_df = name_dataframe(hdb_peaks,
@@ -419,22 +793,59 @@ def peak_metadata():
                                  name1='peak_name',
                                  name2='alt_names')
 
-    # Link the various datasets by choosing best match
+    # Link the various datasets by choosing best match, reusing the cached
+    # matches of unchanged peaks
+    cache = {} if full else read_match_cache()
+
     logger.info('matching HDB peaks to OSM peaks...')
-    osm_link = name_link(hdb_name_df,
-                         osm_name_df,
-                         threshold=0.9)
+    osm_context = match_context(osm_sha256)
+    osm_matches, osm_cache, osm_reused = cached_matches(
+        hdb_name_df, osm_name_df, cache.get('osm', {}), osm_context,
+        n_jobs=n_jobs)
+    osm_link = link_matches(osm_matches, threshold=0.9)
     osm_peaks_linked = {hdb_pk: osm_peaks[osm_pk]
                         for hdb_pk, osm_pk in osm_link.items()}
 
+    # Overrides and, when linking by coordinates, the OSM coordinates and
+    # himal overrides are inputs to the MoTCA matches
+    motca_candidates = None
+    motca_extras = {hdb_pk: [motca_pk] for hdb_pk, motca_pk
+                    in MOTCA_OVERRIDE.items()}
+    if spatial:
+        osm_coords = {hdb_pk: (float(osm_peak['longitude']),
+                               float(osm_peak['latitude']))
+                      for hdb_pk, osm_peak in osm_peaks_linked.items()
+                      if osm_peak.get('longitude')}
+        motca_candidates = nearby_peaks(osm_coords, mot_peaks,
+                                        locator=himals,
+                                        himal_override=HIMAL_OVERRIDE)
+        motca_extras = {hdb_pk: [MOTCA_OVERRIDE.get(hdb_pk),
+                                 osm_coords.get(hdb_pk),
+                                 HIMAL_OVERRIDE.get(hdb_pk)]
+                        for hdb_pk in hdb_peaks}
+
     logger.info('matching HDB peaks to MoTCA peaks...')
-    motca_link = name_link(hdb_name_df,
-                           mot_name_df,
-                           override=MOTCA_OVERRIDE,
-                           threshold=0.7)
+    if spatial:
+        motca_context = match_context(mot_sha256, himal_sha256,
+                                      radius_km=LINK_RADIUS_KM)
+    else:
+        motca_context = match_context(mot_sha256)
+    motca_matches, motca_cache, motca_reused = cached_matches(
+        hdb_name_df, mot_name_df, cache.get('motca', {}), motca_context,
+        extras=motca_extras, candidates=motca_candidates, n_jobs=n_jobs)
+    motca_link = link_matches(motca_matches,
+                              override=MOTCA_OVERRIDE,
+                              threshold=0.7)
     motca_peaks_linked = {hdb_pk: mot_peaks[motca_pk]
                           for hdb_pk, motca_pk in motca_link.items()}
 
+    write_match_cache({'osm': osm_cache, 'motca': motca_cache})
+
+    n_peaks = len(osm_matches)
+    for source, n_reused in [('OSM', osm_reused), ('MoTCA', motca_reused)]:
+        logger.info('{} matches: {} peaks reused, {} recomputed'
+                    .format(source, n_reused, n_peaks - n_reused))
+
     # Combine into a table
     peaks = peak_list(hdb_peaks, himals, HIMAL_OVERRIDE, osm_peaks_linked,
                       motca_peaks_linked)
@@ -459,4 +870,16 @@ def peak_metadata():
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
-    peak_metadata()
+
+    parser = argparse.ArgumentParser(description='Build the peak metadata')
+    parser.add_argument('--spatial', action='store_true',
+                        help='restrict MoTCA links to peaks near the OSM '
+                             'coordinates or in the same himal')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every match instead of reusing the '
+                             'match cache')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='processes scoring name pairs (default: 1)')
+    args = parser.parse_args()
+
+    peak_metadata(spatial=args.spatial, full=args.full, n_jobs=args.n_jobs)
@@ -13,12 +13,14 @@ DATA_SCHEMA = {
             'Summer',
             #'Autumn',  Ignore, default
             'Winter'
-        ]
+        ],
+        'default': 'Autumn'
     },
     'commercial_route': {
         'type': 'indicator',
         'column': 'commercial_route',
-        'value': 'Y'
+        'value': 'Y',
+        'default': 'N'
     },
     'total_members': {'column': 'total_members'},
     'total_hired': {'column': 'total_hired'},
@@ -26,12 +28,14 @@ DATA_SCHEMA = {
     'female': {
         'type': 'indicator',
         'column': 'sex',
-        'value': 'F'
+        'value': 'F',
+        'default': 'M'
     },
     'o2_used': {
         'type': 'indicator',
         'column': 'o2_used',
-        'value': 'Y'
+        'value': 'Y',
+        'default': 'N'
     },
     'height': {'column': 'height'},
     'himal': {
@@ -70,7 +74,8 @@ DATA_SCHEMA = {
             'UMBAK',
             'WESTERNSIKKIM',
             'YOKAPAHAR'
-        ]
+        ],
+        'default': 'KHUMBU'
     }
 }
 
@@ -125,15 +130,179 @@ def set_dict_column(model_df, data, column, column_schema):
 
 
 def update_data_matrix(model_df, data, schema=DATA_SCHEMA, ignore_cols=set()):
-    set_column = set_dict_column if type(data) == dict else set_df_column
+    if type(data) == dict:
+        encoder = ProfileEncoder(schema=schema, ignore_cols=ignore_cols)
+        dtypes = SchemaEncoder(schema=schema, ignore_cols=ignore_cols).dtypes
+
+        vector = encoder.encode(data, dtype=np.float64)
+        for column, value in zip(encoder.columns, vector):
+            model_df[column] = dtypes[column](value)
+        return model_df
 
     for column, column_schema in schema.items():
         if column in ignore_cols: continue
-        set_column(model_df, data, column, column_schema)
+        set_df_column(model_df, data, column, column_schema)
 
     return model_df
 
 
 def data_matrix(data_df, schema=DATA_SCHEMA, ignore_cols=set()):
-    model_df = pd.DataFrame(index=data_df.index.copy(deep=True))
-    return update_data_matrix(model_df, data_df)
+    encoder = SchemaEncoder(schema=schema, ignore_cols=ignore_cols)
+    return encoder.frame(data_df)
+
+
+def schema_columns(schema=DATA_SCHEMA, ignore_cols=set()):
+    '''List the model matrix columns generated by the schema, in order'''
+    columns = []
+    for column, column_schema in schema.items():
+        if column in ignore_cols: continue
+
+        if column_schema.get('type', 'continuous') == 'categorical':
+            for category_value in column_schema['values']:
+                columns.append(column + '_' + category_value.lower())
+        else:
+            columns.append(column)
+
+    return columns
+
+
+class SchemaEncoder:
+    '''Schema compiled into a fixed column layout. Each source column is
+    written into a preallocated matrix in a single vectorized pass, with
+    categorical values mapped to their one-hot column by a code lookup.'''
+
+    def __init__(self, schema=DATA_SCHEMA, ignore_cols=set()):
+        self.columns = schema_columns(schema, ignore_cols=ignore_cols)
+
+        # (source column, type, first output column, indicator value or
+        # category values) for every schema column
+        self.fields = []
+        self.dtypes = {}
+        position = 0
+        for column, column_schema in schema.items():
+            if column in ignore_cols: continue
+
+            column_type = column_schema.get('type', 'continuous')
+            if column_type == 'categorical':
+                values = column_schema['values']
+                width = len(values)
+            else:
+                values = column_schema.get('value')
+                width = 1
+
+            self.fields.append((column_schema['column'], column_type,
+                                position, values))
+            for output_column in self.columns[position:position+width]:
+                self.dtypes[output_column] = (
+                    np.float64 if column_type == 'continuous' else np.uint8)
+            position += width
+
+    def encode(self, data_df, out=None, dtype=np.float32):
+        '''Encode the records into out, or a new (rows, columns) matrix'''
+        n_rows = len(data_df)
+        if out is None:
+            out = np.zeros((n_rows, len(self.columns)), dtype=dtype)
+        else:
+            out[...] = 0
+
+        rows = np.arange(n_rows)
+        for source_column, column_type, position, values in self.fields:
+            source = data_df[source_column]
+
+            if column_type == 'continuous':
+                out[:, position] = source.to_numpy(dtype=np.float64)
+
+            elif column_type == 'indicator':
+                out[:, position] = source.to_numpy() == values
+
+            elif column_type == 'categorical':
+                # Codes are -1 for values outside the schema, which are the
+                # omitted default category
+                codes = pd.Categorical(source, categories=values).codes
+                known = codes >= 0
+                out[rows[known], position + codes[known]] = 1
+
+        return out
+
+    def frame(self, data_df):
+        '''Encode the records as a DataFrame with the index of data_df, the
+        columns of schema_columns and the dtypes of update_data_matrix'''
+        model_df = pd.DataFrame(self.encode(data_df, dtype=np.float64),
+                                index=data_df.index.copy(deep=True),
+                                columns=self.columns)
+        return model_df.astype(self.dtypes, copy=False)
+
+
+class ProfileEncoder:
+    '''Schema compiled for single dict records, such as the expedition
+    profile of an API request. A record is encoded into a vector ordered as
+    schema_columns with one lookup per source column. Indicator and
+    categorical values must be the schema value(s) or the default.'''
+
+    def __init__(self, schema=DATA_SCHEMA, ignore_cols=set()):
+        self.columns = schema_columns(schema, ignore_cols=ignore_cols)
+
+        # Continuous source columns and their positions, and for the other
+        # source columns a lookup of each valid value to the position of its
+        # one, or None for the default
+        continuous   = []
+        self.lookups = []
+        position = 0
+        for column, column_schema in schema.items():
+            if column in ignore_cols: continue
+
+            source_column = column_schema['column']
+            column_type   = column_schema.get('type', 'continuous')
+
+            if column_type == 'continuous':
+                continuous.append((source_column, position))
+                position += 1
+
+            elif column_type == 'indicator':
+                lookup = {column_schema['value']: position}
+                position += 1
+
+            elif column_type == 'categorical':
+                values = column_schema['values']
+                lookup = {value: position + i
+                          for i, value in enumerate(values)}
+                position += len(values)
+
+            if column_type != 'continuous':
+                lookup[column_schema['default']] = None
+                self.lookups.append((source_column, lookup))
+
+        self.continuous_cols = [col for col, _ in continuous]
+        self.continuous_idx  = np.array([i for _, i in continuous],
+                                        dtype=np.intp)
+
+    def validate(self, data):
+        '''Raise a ValueError if a value is not one the schema accepts'''
+        for source_column, lookup in self.lookups:
+            if data[source_column] not in lookup:
+                msg = '{}={!r} must be one of {}'.format(
+                    source_column, data[source_column], sorted(lookup))
+                raise ValueError(msg)
+
+        for source_column in self.continuous_cols:
+            if not np.isfinite(float(data[source_column])):
+                msg = '{}={!r} must be a finite number'.format(
+                    source_column, data[source_column])
+                raise ValueError(msg)
+
+    def encode(self, data, dtype=np.float32):
+        '''Encode the record as a vector ordered as columns'''
+        vector = np.zeros(len(self.columns), dtype=dtype)
+        vector[self.continuous_idx] = [data[col]
+                                       for col in self.continuous_cols]
+
+        try:
+            ones = [lookup[data[source_column]]
+                    for source_column, lookup in self.lookups]
+        except (KeyError, TypeError):
+            self.validate(data)
+            raise
+
+        vector[[i for i in ones if i is not None]] = 1
+
+        return vector
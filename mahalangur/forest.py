@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+### Globals
+
+FOREST_ARRAYS = ['feature', 'threshold', 'value']
+
+# Compiled trees are padded to 2**depth leaves, so deep forests are refused
+MAX_COMPILED_DEPTH = 16
+
+
+### Logic
+
+def compile_tree(tree, depth, feature, threshold, value):
+    '''Write a fitted sklearn tree into the complete binary tree layout, where
+    the children of position i are 2i+1 and 2i+2. Leaves above the bottom
+    level are pushed down the left-most path, whose thresholds are +inf.'''
+    n_internal = 2**depth - 1
+
+    # Older versions store class counts, newer versions fractions
+    proba = tree.value[:, 0, :]
+    proba = proba / proba.sum(axis=1, keepdims=True)
+
+    stack = [(0, 0, 0)]
+    while stack:
+        node, position, level = stack.pop()
+
+        if tree.children_left[node] == -1:
+            for _ in range(level, depth):
+                position = 2*position + 1
+            value[position - n_internal] = proba[node]
+        else:
+            feature[position]   = tree.feature[node]
+            threshold[position] = tree.threshold[node]
+
+            stack.append((tree.children_left[node] , 2*position + 1, level+1))
+            stack.append((tree.children_right[node], 2*position + 2, level+1))
+
+
+def compile_forest(rf_model, max_depth=MAX_COMPILED_DEPTH):
+    '''Compile a fitted random forest into stacked fixed-depth arrays'''
+    estimators = rf_model.estimators_
+
+    depth = max(estimator.tree_.max_depth for estimator in estimators)
+    if depth > max_depth:
+        msg = 'forest depth {} exceeds max_depth={}'.format(depth, max_depth)
+        raise ValueError(msg)
+
+    n_trees   = len(estimators)
+    n_classes = len(rf_model.classes_)
+
+    feature   = np.zeros((n_trees, 2**depth - 1), dtype=np.intp)
+    threshold = np.full((n_trees, 2**depth - 1), np.inf)
+    value     = np.zeros((n_trees, 2**depth, n_classes))
+
+    for i, estimator in enumerate(estimators):
+        compile_tree(estimator.tree_, depth, feature[i], threshold[i],
+                     value[i])
+
+    arrays = {'feature': feature, 'threshold': threshold, 'value': value}
+
+    return CompiledForest(arrays, rf_model.classes_)
+
+
+def check_forest(rf_model, forest, X, atol=1e-9):
+    '''Raise a ValueError if the forest and the sklearn model disagree'''
+    error = np.abs(rf_model.predict_proba(X) - forest.predict_proba(X)).max()
+    if error > atol:
+        msg = 'compiled forest differs from model by {}'.format(error)
+        raise ValueError(msg)
+
+
+class CompiledForest:
+    '''Random forest classifier evaluated from stacked fixed-depth arrays.
+    Every tree takes exactly depth steps, so all rows and trees are advanced
+    together with vectorized gathers. The arrays may be memory-mapped.'''
+
+    def __init__(self, arrays, classes, value_scale=1.0, chunk_size=4096):
+        self.feature   = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.value     = arrays['value']
+
+        # Leaf values may be stored as integers, scaled by value_scale
+        self.classes_    = np.asarray(classes)
+        self.value_scale = value_scale
+        self.chunk_size  = chunk_size
+
+        n_trees, n_leaves, _ = self.value.shape
+        self.n_trees = n_trees
+        self.depth   = n_leaves.bit_length() - 1
+
+        # Flat views so that each level is a handful of 1-D np.take gathers
+        self._n_internal   = n_leaves - 1
+        self._node_offsets = np.arange(n_trees) * self._n_internal
+        self._leaf_offsets = np.arange(n_trees) * n_leaves
+        self._feature      = self.feature.reshape(-1)
+        self._threshold    = self.threshold.reshape(-1)
+        self._value        = self.value.reshape(n_trees*n_leaves, -1)
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in FOREST_ARRAYS}
+
+    def _predict_chunk(self, X):
+        n_rows, n_cols = X.shape
+        row_offsets = (np.arange(n_rows) * n_cols)[:, np.newaxis]
+        X = X.reshape(-1)
+
+        # (rows, trees) positions in the complete tree, one level per step
+        position = np.zeros((n_rows, self.n_trees), dtype=np.intp)
+        for _ in range(self.depth):
+            node = position + self._node_offsets
+            cell = row_offsets + np.take(self._feature, node)
+            go_right = np.take(X, cell) > np.take(self._threshold, node)
+
+            position *= 2
+            position += 1
+            position += go_right
+
+        position += self._leaf_offsets - self._n_internal
+        proba = np.take(self._value, position, axis=0).mean(axis=1)
+        if self.value_scale != 1.0:
+            proba /= self.value_scale
+
+        return proba
+
+    def predict_proba(self, X):
+        # Match sklearn, which compares float32 features to the thresholds
+        X = np.ascontiguousarray(X, dtype=np.float32)
+
+        proba = np.empty((X.shape[0], self.value.shape[2]))
+        for start in range(0, X.shape[0], self.chunk_size):
+            stop = start + self.chunk_size
+            proba[start:stop] = self._predict_chunk(X[start:stop])
+
+        return proba
@@ -1,65 +1,693 @@
 # -*- coding: utf-8 -*-
+import argparse
+import csv
+import json
 import logging
+import multiprocessing as mp
 import numpy as np
+import os
 import pandas as pd
+import shutil
 import pickle
 import sklearn
 import sqlite3
 import joblib
 from . import DATABASE_PATH, LOG_FORMAT, MODEL_DIR
+from .artifact import ARTIFACT_PATH, artifact_metadata, write_artifact
+from .data.utils import sha256_file
 from .feat import utils
 from hashlib import sha256
+from pathlib import Path
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from time import perf_counter
 
 
-### Logic
+### Globals
+
+DATA_FILTER = 'expedition_year >= 1970'
+DATA_SQL = 'SELECT * FROM model_base WHERE {};'.format(DATA_FILTER)
+
+# The matrix is streamed from the database ordered by expedition_year, so
+# that a range of years is a contiguous slice of the rows
+STREAM_SQL = ('SELECT * FROM model_base WHERE {} '
+              'ORDER BY expedition_year, expedition_id, member_id;'
+              .format(DATA_FILTER))
+STREAM_SIZE_SQL = ('SELECT COUNT(*), MAX(LENGTH(expedition_id)) '
+                   'FROM model_base WHERE {};'.format(DATA_FILTER))
+
+# Records read and encoded at a time, which bounds the memory used to build
+# the matrix
+MATRIX_CHUNK_SIZE = 50000
+
+# Encoded feature matrices, one directory per hash of the database content
+# and encoding. Bump MATRIX_VERSION when the layout of the files changes.
+MATRIX_DIR     = (MODEL_DIR / 'matrix').resolve()
+MATRIX_VERSION = 1
+MATRIX_ARRAYS  = ['X', 'y', 'expedition_id']
+
+MODEL_PATH    = (MODEL_DIR / 'model-rf_v1.0.pickle').resolve()
+MANIFEST_PATH = (MODEL_DIR / 'model-rf_v1.0.json'  ).resolve()
+
+RF_PARAMS = {
+    'criterion'   : 'gini',
+    'max_depth'   : 5,
+    'n_estimators': 90
+}
+
+# Trees grown on the new and changed expeditions by an incremental update
+INCREMENTAL_TREES = 30
+
+# An incremental update rebuilds the model instead if any metric of
+# data_drift exceeds its threshold: the fraction of previously seen
+# expeditions that changed or disappeared, the largest shift in a feature's
+# mean over the new rows in baseline standard deviations, the drop in
+# accuracy on the new rows below the baseline out-of-bag score, and the
+# size of the forest
+DRIFT_THRESHOLDS = {
+    'changed'      : 0.02,
+    'feature_shift': 0.5,
+    'accuracy_drop': 0.05,
+    'n_estimators' : 300
+}
+
+# New seasons always shift the year, so it is not a drift signal
+DRIFT_IGNORE_COLS = {'expedition_year'}
 
-def get_data():
-    sql = 'SELECT * FROM model_base WHERE expedition_year >= 1970;'
+# Hyperparameters explored by the search, overriding RF_PARAMS
+SEARCH_GRID = {
+    'criterion'       : ['gini', 'entropy'],
+    'max_depth'       : [4, 5, 6, 8, 10],
+    'n_estimators'    : [60, 90, 150],
+    'min_samples_leaf': [1, 5, 20],
+    'max_features'    : ['sqrt', 0.5]
+}
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    df = pd.read_sql(sql, conn, index_col=['expedition_id', 'member_id'])
+SEARCH_DIR = (MODEL_DIR / 'search').resolve()
+
+# Rows scored per call when timing predict_proba, about one request's worth
+# of peaks
+SEARCH_PREDICT_ROWS = 512
+
+# Read-only training data of a search or backtest worker process
+WORKER_DATA = {}
+
+
+### Logic
+
+def get_data(database_path=DATABASE_PATH):
+    conn = sqlite3.connect(database_path)
+    df = pd.read_sql(DATA_SQL, conn, index_col=['expedition_id', 'member_id'])
     conn.close()
 
     return df
 
 
-def train_model(X, y):
+### Logic - Feature matrix cache
+
+def database_sha256(database_path=DATABASE_PATH, matrix_dir=MATRIX_DIR):
+    '''Hash of the database file. The hash is remembered against the file's
+    size and modification time so an unchanged database is not re-read.'''
+    stat = os.stat(database_path)
+    stat_key = [str(Path(database_path).resolve()), stat.st_size,
+                stat.st_mtime_ns]
+
+    stat_path = matrix_dir / 'database.json'
+    if stat_path.exists():
+        with open(stat_path, 'r') as stat_file:
+            last_stat = json.load(stat_file)
+        if last_stat['stat'] == stat_key:
+            return last_stat['sha256']
+
+    database_hash = sha256_file(database_path)
+
+    if not matrix_dir.exists():
+        matrix_dir.mkdir(parents=True)
+    with open(stat_path, 'w') as stat_file:
+        json.dump({'stat': stat_key, 'sha256': database_hash}, stat_file)
+
+    return database_hash
+
+
+def matrix_key(database_path=DATABASE_PATH, matrix_dir=MATRIX_DIR,
+               schema=utils.DATA_SCHEMA):
+    '''Content address of the feature matrix: the database, the query and
+    the schema it is encoded with'''
+    key = json.dumps({
+        'database': database_sha256(database_path, matrix_dir),
+        'sql'     : STREAM_SQL,
+        'schema'  : schema,
+        'version' : MATRIX_VERSION
+    }, sort_keys=True)
+
+    return sha256(key.encode('utf-8')).hexdigest()
+
+
+def npy_writer(npy_path, dtype, shape):
+    '''Open a .npy file for the array to be written in row order'''
+    npy_file = open(npy_path, 'wb')
+    np.lib.format.write_array_header_1_0(npy_file, {
+        'descr'        : np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape'        : shape
+    })
+
+    return npy_file
+
+
+def write_matrix(key_dir, key, database_path=DATABASE_PATH,
+                 chunk_size=MATRIX_CHUNK_SIZE):
+    '''Stream the model_base records from the database in chunks, encoding
+    each chunk into a preallocated buffer and appending it to the .npy files
+    in key_dir. Only one chunk of records is held in memory at a time.'''
+    encoder = utils.SchemaEncoder()
+
+    # Write to a temporary directory and rename it, so that a concurrent
+    # reader never sees a partial matrix
+    temp_dir = key_dir.with_name(key_dir.name + '.tmp')
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    temp_dir.mkdir(parents=True)
+
+    conn = sqlite3.connect(database_path)
+    n_rows, id_length = conn.execute(STREAM_SIZE_SQL).fetchone()
+    id_dtype = '<U{}'.format(id_length or 1)
+
+    X_buffer = np.empty((chunk_size, len(encoder.columns)), dtype=np.float32)
+    npy_files = {
+        'X'            : npy_writer(temp_dir / 'X.npy', np.float32,
+                                    (n_rows, X_buffer.shape[1])),
+        'y'            : npy_writer(temp_dir / 'y.npy', np.uint8, (n_rows,)),
+        'expedition_id': npy_writer(temp_dir / 'expedition_id.npy', id_dtype,
+                                    (n_rows,))
+    }
+
+    n_written = 0
+    for chunk_df in pd.read_sql(STREAM_SQL, conn, chunksize=chunk_size):
+        X_chunk = encoder.encode(chunk_df, out=X_buffer[:len(chunk_df)])
+        y_chunk = (chunk_df['successful_summit'] == 'Y')\
+                  .to_numpy(dtype=np.uint8)
+        id_chunk = chunk_df['expedition_id'].to_numpy(dtype=id_dtype)
+
+        npy_files['X'].write(X_chunk.data)
+        npy_files['y'].write(y_chunk.data)
+        npy_files['expedition_id'].write(id_chunk.data)
+
+        n_written += len(chunk_df)
+    conn.close()
+
+    for npy_file in npy_files.values():
+        npy_file.close()
+
+    if n_written != n_rows:
+        shutil.rmtree(temp_dir)
+        raise ValueError('database changed while the matrix was read')
+
+    metadata = {
+        'sha256' : key,
+        'columns': encoder.columns,
+        'rows'   : n_rows
+    }
+    with open(temp_dir / 'matrix.json', 'w') as meta_file:
+        json.dump(metadata, meta_file)
+
+    try:
+        os.rename(temp_dir, key_dir)
+    except OSError:
+        # Another process cached the same matrix first
+        shutil.rmtree(temp_dir)
+
+    return key_dir
+
+
+def read_matrix(key_dir):
+    '''Memory-map the arrays of a cached feature matrix'''
+    with open(key_dir / 'matrix.json', 'r') as meta_file:
+        metadata = json.load(meta_file)
+
+    matrix = {name: np.load(key_dir / (name + '.npy'), mmap_mode='r')
+              for name in MATRIX_ARRAYS}
+
+    return matrix, metadata
+
+
+def load_matrix(database_path=DATABASE_PATH, matrix_dir=MATRIX_DIR,
+                chunk_size=MATRIX_CHUNK_SIZE):
+    '''Feature matrix arrays (MATRIX_ARRAYS) and metadata for the database,
+    read from the cache or encoded and cached if the database or schema has
+    changed'''
+    logger = logging.getLogger('mahalangur.rfmodel')
+
+    key = matrix_key(database_path, matrix_dir)
+    key_dir = matrix_dir / key
+
+    if not key_dir.exists():
+        logger.info('streaming data matrix {}'.format(key[:12]))
+        write_matrix(key_dir, key, database_path, chunk_size)
+    else:
+        logger.info('using cached data matrix {}'.format(key[:12]))
+
+    return read_matrix(key_dir)
+
+
+def _init_matrix_worker(key_dir):
+    # Workers memory-map the cached matrix read-only, so every process shares
+    # the page cache rather than holding a copy
+    matrix, _ = read_matrix(key_dir)
+    WORKER_DATA['X'] = matrix['X']
+    WORKER_DATA['y'] = matrix['y']
+
+
+### Logic - Training
+
+def collapse_rows(X, y):
+    '''Group identical (features, target) rows, returning the unique rows and
+    the number of times each occurs as a sample weight'''
+    Xy = np.column_stack([np.asarray(X, dtype=np.float32),
+                          np.asarray(y, dtype=np.float32)])
+    Xy_unique, counts = np.unique(Xy, axis=0, return_counts=True)
+
+    X_unique = np.ascontiguousarray(Xy_unique[:, :-1])
+    y_unique = Xy_unique[:, -1].astype(np.uint8)
+
+    return X_unique, y_unique, counts.astype(np.float64)
+
+
+def oob_score(rf_model, y, sample_weight=None):
+    '''Out-of-bag accuracy, weighting each row by its sample weight'''
+    if sample_weight is None:
+        return rf_model.oob_score_
+
+    oob_proba = rf_model.oob_decision_function_
+    scored = ~np.isnan(oob_proba).any(axis=1)
+    correct = rf_model.classes_[oob_proba[scored].argmax(axis=1)] == y[scored]
+
+    return np.average(correct, weights=sample_weight[scored])
+
+
+def train_model(X, y, sample_weight=None, **params):
     rf_model = RandomForestClassifier(
-        criterion='gini',
-        max_depth=5,
-        n_estimators=90,
-        oob_score=True
+        oob_score=True,
+        **{**RF_PARAMS, **params}
     )
 
-    rf_model.fit(X, y)
+    rf_model.fit(X, y, sample_weight=sample_weight)
 
     return rf_model
 
 
-def build_model():
+def fit_rows(X, y, rf_model=None, collapse=False, **params):
+    '''Fit a new forest to the rows, or grow the trees of rf_model on them,
+    returning the forest and its out-of-bag score (None when growing)'''
     logger = logging.getLogger('mahalangur.rfmodel')
 
-    logger.info('retrieving data')
-    data_df = get_data()
+    sample_weight = None
+    if collapse:
+        n_rows = X.shape[0]
+        X, y, sample_weight = collapse_rows(X, y)
+        logger.info('collapsed {} rows to {} unique rows'
+                    .format(n_rows, X.shape[0]))
 
-    logger.info('creating data matrix')
-    X = utils.data_matrix(data_df)
-    y = (data_df['successful_summit'] == 'Y').astype(dtype=np.uint8)
+        # Bootstrap samples draw the unique rows uniformly, so all copies of
+        # a row are in or out of the bag together
+        fit_params = {**RF_PARAMS, **params}
+        if rf_model is not None:
+            fit_params = {**rf_model.get_params(), **params}
+        if fit_params.get('bootstrap', True):
+            logger.warning('bootstrapping collapsed rows is not equivalent '
+                           'to bootstrapping every row: the forest and its '
+                           'out-of-bag score differ from a full fit')
 
-    logger.info('training random forest model')
-    rf_model = train_model(X, y)
+    if rf_model is None:
+        rf_model = train_model(X, y, sample_weight=sample_weight, **params)
+        return rf_model, oob_score(rf_model, y, sample_weight)
 
-    logger.info('out-of-bag score: {}'.format(rf_model.oob_score_))
+    # Out-of-bag rows cannot be recovered for trees fit to earlier data
+    rf_model.set_params(warm_start=True, oob_score=False, **params)
+    rf_model.fit(X, y, sample_weight=sample_weight)
+
+    return rf_model, None
+
+
+def save_model(rf_model, manifest, model_path=MODEL_PATH,
+               manifest_path=MANIFEST_PATH):
+    logger = logging.getLogger('mahalangur.rfmodel')
 
-    model_path = (MODEL_DIR / 'model-rf_v1.0.pickle').resolve()
     if not model_path.parent.exists():
         model_path.parent.mkdir(parents=True)
 
     logger.info('saving model to file \'{}\''.format(model_path.name))
     joblib.dump(rf_model, model_path)
 
+    manifest['versions'][-1]['model_sha256'] = sha256_file(model_path)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    logger.info('writing model artifact \'{}\''.format(ARTIFACT_PATH.name))
+    write_artifact(rf_model, ARTIFACT_PATH,
+                   artifact_metadata(model_path, training_summary(manifest)))
+
+    return model_path
+
+
+def training_summary(manifest):
+    '''Training data hashes and metrics of a manifest for the model artifact'''
+    return {
+        'matrix_sha256': manifest['versions'][-1]['matrix_sha256'],
+        'oob_score'    : manifest['baseline']['oob_score'],
+        'success_rate' : manifest['baseline']['success_rate'],
+        'versions'     : [
+            {key: value for key, value in version.items()
+             if key != 'expeditions'}
+            for version in manifest['versions']
+        ]
+    }
+
+
+def build_model(collapse=False):
+    '''Train the forest on the cached feature matrix. With collapse, the
+    forest is fit to the unique rows weighted by their counts, which for
+    per-member data is a fraction of the rows. Since the trees bootstrap the
+    unique rows, the forest and its out-of-bag score then differ from those
+    of a fit to every row.'''
+    logger = logging.getLogger('mahalangur.rfmodel')
+
+    matrix, metadata = load_matrix()
+    X, y = matrix['X'], matrix['y']
+
+    logger.info('training random forest model')
+    rf_model, score = fit_rows(X, y, collapse=collapse)
+
+    if collapse:
+        logger.info('out-of-bag score over unique rows, weighted by count: '
+                    '{}'.format(score))
+    else:
+        logger.info('out-of-bag score: {}'.format(score))
+
+    manifest = {
+        'columns' : metadata['columns'],
+        'baseline': data_baseline(X, y, score),
+        'versions': [model_version('full', metadata, rf_model,
+                                   expedition_hashes(matrix))]
+    }
+    manifest['versions'][-1]['collapse'] = collapse
+
+    return save_model(rf_model, manifest)
+
+
+### Logic - Incremental training
+
+def expedition_hashes(matrix, rows=slice(None)):
+    '''Hash of the encoded rows of every expedition, keyed by expedition_id'''
+    ids = matrix['expedition_id'][rows]
+    X = np.asarray(matrix['X'][rows])
+    y = np.asarray(matrix['y'][rows])
+
+    order = np.argsort(ids, kind='mergesort')
+    expedition_ids, starts = np.unique(ids[order], return_index=True)
+    groups = np.split(order, starts[1:])
+
+    return {
+        expedition_id: sha256(X[group].tobytes() + y[group].tobytes())
+                       .hexdigest()[:16]
+        for expedition_id, group in zip(expedition_ids.tolist(), groups)
+    }
+
+
+def model_version(mode, metadata, rf_model, hashes):
+    '''Manifest entry recording the expeditions a version's trees saw'''
+    return {
+        'mode'         : mode,
+        'matrix_sha256': metadata['sha256'],
+        'n_estimators' : rf_model.n_estimators,
+        'expeditions'  : hashes
+    }
+
+
+def data_baseline(X, y, score):
+    '''Summary of the full training data that later data is compared to'''
+    return {
+        'feature_mean': np.mean(X, axis=0, dtype=np.float64).tolist(),
+        'feature_std' : np.std(X, axis=0, dtype=np.float64).tolist(),
+        'success_rate': float(np.mean(y)),
+        'oob_score'   : score
+    }
+
+
+def seen_expeditions(manifest):
+    '''Latest hash of every expedition seen by any version of the model'''
+    seen = {}
+    for version in manifest['versions']:
+        seen.update(version['expeditions'])
+
+    return seen
+
+
+def data_drift(manifest, rf_model, hashes, X_new, y_new):
+    '''Drift of the current data from what the model was trained on'''
+    seen = seen_expeditions(manifest)
+    changed = sum(1 for expedition_id, expedition_hash in seen.items()
+                  if hashes.get(expedition_id) != expedition_hash)
+
+    baseline = manifest['baseline']
+    mean = np.array(baseline['feature_mean'])
+    std = np.array(baseline['feature_std'])
+
+    shift = np.abs(np.mean(X_new, axis=0, dtype=np.float64) - mean)
+    shift = np.divide(shift, std, out=np.zeros_like(shift), where=std > 0)
+    for i, column in enumerate(manifest['columns']):
+        if column in DRIFT_IGNORE_COLS:
+            shift[i] = 0.0
+
+    accuracy = np.mean(rf_model.predict(X_new) == y_new)
+
+    return {
+        'changed'      : changed / max(len(seen), 1),
+        'feature_shift': float(shift.max()),
+        'accuracy_drop': baseline['oob_score'] - float(accuracy),
+        'n_estimators' : rf_model.n_estimators + INCREMENTAL_TREES
+    }
+
+
+def update_model(collapse=False):
+    '''Grow INCREMENTAL_TREES trees on the expeditions that are new or have
+    changed since the model was trained, falling back to build_model when
+    there is no model to update or the data has drifted past
+    DRIFT_THRESHOLDS'''
+    logger = logging.getLogger('mahalangur.rfmodel')
+
+    if not (MODEL_PATH.exists() and MANIFEST_PATH.exists()):
+        logger.info('no previous model, rebuilding')
+        return build_model(collapse=collapse)
+
+    with open(MANIFEST_PATH, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest['versions'][-1]['model_sha256'] != sha256_file(MODEL_PATH):
+        logger.info('model does not match its manifest, rebuilding')
+        return build_model(collapse=collapse)
+
+    matrix, metadata = load_matrix()
+    if metadata['columns'] != manifest['columns']:
+        logger.info('feature columns changed, rebuilding')
+        return build_model(collapse=collapse)
+
+    hashes = expedition_hashes(matrix)
+    seen = seen_expeditions(manifest)
+    new_hashes = {expedition_id: expedition_hash
+                  for expedition_id, expedition_hash in hashes.items()
+                  if seen.get(expedition_id) != expedition_hash}
+
+    if not new_hashes:
+        logger.info('no new or changed expeditions, model is up to date')
+        return MODEL_PATH
+
+    rows = np.isin(matrix['expedition_id'], list(new_hashes))
+    X_new, y_new = matrix['X'][rows], matrix['y'][rows]
+    logger.info('{} new or changed expeditions ({} rows)'
+                .format(len(new_hashes), X_new.shape[0]))
+
+    if np.unique(y_new).size < 2:
+        logger.info('new rows have a single outcome, rebuilding')
+        return build_model(collapse=collapse)
+
+    rf_model = joblib.load(MODEL_PATH)
+
+    drift = data_drift(manifest, rf_model, hashes, X_new, y_new)
+    logger.info('drift: {}'.format(drift))
+
+    exceeded = [metric for metric, threshold in DRIFT_THRESHOLDS.items()
+                if drift[metric] > threshold]
+    if exceeded:
+        logger.info('drift exceeds {}, rebuilding'.format(exceeded))
+        return build_model(collapse=collapse)
+
+    logger.info('growing {} trees'.format(INCREMENTAL_TREES))
+    rf_model, _ = fit_rows(
+        X_new, y_new, rf_model=rf_model, collapse=collapse,
+        n_estimators=rf_model.n_estimators + INCREMENTAL_TREES
+    )
+
+    version = model_version('incremental', metadata, rf_model, new_hashes)
+    version['drift'] = drift
+    version['collapse'] = collapse
+    manifest['versions'].append(version)
+
+    return save_model(rf_model, manifest)
+
+
+### Logic - Search
+
+def search_configs(grid=SEARCH_GRID, n_iter=None, random_state=0):
+    '''Every configuration of the grid, or n_iter sampled configurations'''
+    if n_iter is None:
+        return list(ParameterGrid(grid))
+
+    return list(ParameterSampler(grid, n_iter=n_iter,
+                                 random_state=random_state))
+
+
+def config_key(params, data_sha256):
+    '''Cache key of a configuration evaluated on the data with the hash'''
+    config = json.dumps({'params': params, 'data': data_sha256},
+                        sort_keys=True)
+    return sha256(config.encode('utf-8')).hexdigest()[:16]
+
+
+def evaluate_config(params, repeat=20):
+    '''Fit a forest on the worker's data and measure its out-of-bag score,
+    fit time and predict_proba latency'''
+    X, y = WORKER_DATA['X'], WORKER_DATA['y']
+
+    start = perf_counter()
+    rf_model = train_model(X, y, n_jobs=1, **params)
+    fit_seconds = perf_counter() - start
+
+    X_predict = np.array(X[:SEARCH_PREDICT_ROWS])
+    predict_times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        rf_model.predict_proba(X_predict)
+        predict_times.append(perf_counter() - start)
+
+    return {
+        'params'     : params,
+        'oob_score'  : rf_model.oob_score_,
+        'fit_s'      : fit_seconds,
+        'predict_ms' : 1000*float(np.median(predict_times)),
+        'node_count' : sum(tree.tree_.node_count
+                           for tree in rf_model.estimators_)
+    }
+
+
+def _evaluate_cached(args):
+    params, result_path = args
+
+    result = evaluate_config(params)
+    with open(result_path, 'w') as result_file:
+        json.dump(result, result_file)
+
+    return result
+
+
+def search_model(key_dir, configs, search_dir=SEARCH_DIR, n_jobs=None):
+    '''Evaluate the configurations on the cached feature matrix in key_dir
+    across a process pool. Each result is written to search_dir as it
+    completes, and configurations with a result already on disk for the same
+    matrix are not refitted.'''
+    logger = logging.getLogger('mahalangur.rfmodel')
+
+    if not search_dir.exists():
+        search_dir.mkdir(parents=True)
+
+    data_sha256 = key_dir.name
+
+    results = []
+    pending = []
+    for params in configs:
+        result_path = search_dir / (config_key(params, data_sha256) + '.json')
+        if result_path.exists():
+            with open(result_path, 'r') as result_file:
+                results.append(json.load(result_file))
+        else:
+            pending.append((params, result_path))
+
+    logger.info('{} configurations cached, {} to evaluate'
+                .format(len(results), len(pending)))
+
+    with mp.Pool(n_jobs, initializer=_init_matrix_worker,
+                 initargs=(key_dir,)) as pool:
+        for result in pool.imap_unordered(_evaluate_cached, pending):
+            logger.info('oob_score {:.4f} for {}'
+                        .format(result['oob_score'], result['params']))
+            results.append(result)
+
+    return sorted(results, key=lambda result: -result['oob_score'])
+
+
+def write_report(results, report_path):
+    '''Write the ranked search results to a CSV file'''
+    param_names = sorted({name for result in results
+                          for name in result['params']})
+    headers = (['rank', 'oob_score', 'fit_s', 'predict_ms', 'node_count']
+               + param_names)
+
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(headers)
+        for rank, result in enumerate(results, start=1):
+            writer.writerow(
+                [rank, '{:.5f}'.format(result['oob_score']),
+                 '{:.3f}'.format(result['fit_s']),
+                 '{:.3f}'.format(result['predict_ms']),
+                 result['node_count']]
+                + [result['params'].get(name) for name in param_names]
+            )
+
+    return report_path
+
+
+def search(n_iter=None, n_jobs=None):
+    logger = logging.getLogger('mahalangur.rfmodel')
+
+    _, metadata = load_matrix()
+
+    configs = search_configs(n_iter=n_iter)
+    logger.info('searching {} configurations'.format(len(configs)))
+    results = search_model(MATRIX_DIR / metadata['sha256'], configs,
+                           n_jobs=n_jobs)
+
+    report_path = SEARCH_DIR / 'search_report.csv'
+    logger.info('writing report to \'{}\''.format(report_path.name))
+    write_report(results, report_path)
+
+    best = results[0]
+    logger.info('best out-of-bag score {:.4f} for {}'
+                .format(best['oob_score'], best['params']))
+
+    return results
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
-    build_model()
+
+    parser = argparse.ArgumentParser(description='Train the random forest')
+    parser.add_argument('--collapse', action='store_true',
+                        help='train on unique rows weighted by count; with '
+                             'bootstrapping, not equivalent to a full fit')
+    parser.add_argument('--incremental', action='store_true',
+                        help='grow trees on new and changed expeditions')
+    parser.add_argument('--search', action='store_true',
+                        help='search SEARCH_GRID instead of training')
+    parser.add_argument('--n-iter', type=int, default=None,
+                        help='sample this many configurations from the grid')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='search worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    if args.search:
+        search(n_iter=args.n_iter, n_jobs=args.n_jobs)
+    elif args.incremental:
+        update_model(collapse=args.collapse)
+    else:
+        build_model(collapse=args.collapse)
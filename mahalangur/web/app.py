@@ -1,20 +1,87 @@
 import csv
+import hmac
 import importlib.resources as res
 import joblib
 import json
-import pandas as pd
-from ..feat import utils
+import logging
+import os
+import threading
+from .batching import MicroBatcher
+from .cache import ResponseCache
+from .cube import ProbabilityCube
+from .engine import PEAK_COLS, PeakEngine
+from .metrics import Registry, gauge_lines
+from .payload import Payload
+from .spatial import PeakIndex
+from .store import PAYLOAD_DIR, load_store
 from .. import LOG_FORMAT
-from flask import Flask, render_template, request, jsonify
+from ..artifact import load_artifact
+from ..data.utils import sha256_file
+from ..feat.utils import ProfileEncoder
+from ..forest import compile_forest
+from flask import Flask, g, render_template, request, jsonify
+from pathlib import Path
+from time import perf_counter, sleep
 
 ### Globals
 
 app = Flask(__name__)
+app.config.update(
+    RESPONSE_CACHE_SIZE=256,   # Number of expedition profiles to keep
+    RESPONSE_CACHE_TTL=3600.0, # Seconds before an entry expires, or None
+    BATCH_MAX_PROFILES=64,     # Largest number of profiles per batch request
+    MICRO_BATCH_WINDOW=None,   # Seconds to gather concurrent requests, or None
+    MICRO_BATCH_SIZE=32,       # Most requests scored in one micro-batch
+    # Directory written by mahalangur.web.store to memory-map the model and
+    # peak matrix from, shared between worker processes, or None
+    MODEL_STORE=os.environ.get('MAHALANGUR_MODEL_STORE'),
+    # Model artifact written by mahalangur.artifact to memory-map the forest
+    # from instead of unpickling the model asset, or None
+    MODEL_ARTIFACT=os.environ.get('MAHALANGUR_MODEL_ARTIFACT'),
+    GEOJSON_MAX_AGE=3600,      # Seconds browsers may reuse the geojson
+    # Token expected in the X-Admin-Token header of /admin/reload, or None to
+    # disable the endpoint
+    ADMIN_TOKEN=os.environ.get('MAHALANGUR_ADMIN_TOKEN'),
+    RELOAD_POLL_INTERVAL=None  # Seconds between model file checks, or None
+)
 
-MODEL         = None
-PEAK_GEOSJON  = None
-HIMAL_GEOJSON = None
-PEAK_DF       = None
+ASSETS = None
+
+# Geojson and static responses, which outlive model reloads
+STATIC      = None
+STATIC_LOCK = threading.Lock()
+
+RELOAD_LOCK   = threading.Lock()
+RELOAD_THREAD = None
+RELOAD_ERROR  = None
+
+METRICS = Registry()
+
+REQUESTS = METRICS.counter(
+    'mahalangur_requests_total',
+    'HTTP requests by endpoint and status code',
+    labelnames=['endpoint', 'code']
+)
+API_FAILURES = METRICS.counter(
+    'mahalangur_api_failures_total',
+    'API requests answered with a failure status',
+    labelnames=['endpoint']
+)
+RELOADS = METRICS.counter(
+    'mahalangur_model_reloads_total',
+    'Background model reloads by outcome',
+    labelnames=['outcome']
+)
+REQUEST_SECONDS = METRICS.histogram(
+    'mahalangur_request_seconds',
+    'Request latency in seconds by endpoint',
+    labelnames=['endpoint']
+)
+STAGE_SECONDS = METRICS.histogram(
+    'mahalangur_stage_seconds',
+    'Latency in seconds of each stage of the prediction path',
+    labelnames=['stage']
+)
 
 DEFAULTS = {
     'expedition_year' : (int, 2020    ),
@@ -27,86 +94,498 @@ DEFAULTS = {
     'o2_used'         : (str, 'N'     )
 }
 
+PROFILE = ProfileEncoder(ignore_cols=PEAK_COLS)
+
 
 ### Asset Loading
 
-def load_assets():
-    global MODEL
-    global PEAK_GEOJSON
-    global HIMAL_GEOJSON
-    global PEAK_DF
+class Assets:
+    '''The model and everything derived from it. Requests read the global
+    ASSETS once, so a request in flight finishes on the version it started
+    with while a reload swaps in a new one.'''
+
+    def __init__(self, **assets):
+        self.model         = assets['model']
+        self.model_sha256  = assets['model_sha256']
+        self.model_path    = assets['model_path']
+        self.model_mtime   = assets['model_mtime']
+        self.peak_geojson  = assets['peak_geojson']
+        self.himal_geojson = assets['himal_geojson']
+        self.payloads      = assets['payloads']
+        self.engine        = assets['engine']
+        self.peak_index    = assets['peak_index']
+        self.cube          = assets['cube']
+        self.batcher       = assets['batcher']
+        self.cache         = assets['cache']
 
-    with res.path('mahalangur.assets', 'rfmodel.pickle') as model_path:
-        MODEL = joblib.load(model_path)
+    def close(self):
+        '''Release resources once these assets have been swapped out'''
+        if self.batcher is not None:
+            self.batcher.close()
 
+
+def model_path():
+    '''File whose change means a new model: the pickle asset, the artifact
+    or the store'''
+    if app.config['MODEL_STORE'] is not None:
+        return Path(app.config['MODEL_STORE']) / 'store.json'
+    if app.config['MODEL_ARTIFACT'] is not None:
+        return Path(app.config['MODEL_ARTIFACT'])
+
+    with res.path('mahalangur.assets', 'rfmodel.pickle') as pickle_path:
+        return pickle_path
+
+
+def build_static(cache_dir=None):
+    '''Read the geojson and render and compress the static responses, which
+    do not depend on the model'''
     meta_dir = 'mahalangur.data.metadata'
     with res.path(meta_dir, 'web_peak.geojson') as peak_path:
-        with open(peak_path, 'r') as geojson_file:
-            PEAK_GEOJSON = json.load(geojson_file)
+        with open(peak_path, 'rb') as geojson_file:
+            peak_bytes = geojson_file.read()
+            peak_geojson = json.loads(peak_bytes)
 
     with res.path(meta_dir, 'web_himal.geojson') as himal_path:
-        with open(himal_path, 'r') as geojson_file:
-            HIMAL_GEOJSON = json.load(geojson_file)
+        with open(himal_path, 'rb') as geojson_file:
+            himal_bytes = geojson_file.read()
+            himal_geojson = json.loads(himal_bytes)
+
+    geojson_cache = 'public, max-age={}'.format(app.config['GEOJSON_MAX_AGE'])
+    with app.app_context():
+        index_html = render_template('map.j2')
+
+    payloads = {
+        'index'        : Payload(index_html.encode('utf-8'), 'text/html',
+                                 cache_dir=cache_dir),
+        'peak_geojson' : Payload(peak_bytes, 'application/geo+json',
+                                 cache_control=geojson_cache,
+                                 cache_dir=cache_dir),
+        'himal_geojson': Payload(himal_bytes, 'application/geo+json',
+                                 cache_control=geojson_cache,
+                                 cache_dir=cache_dir)
+    }
+
+    return peak_geojson, himal_geojson, payloads
+
+
+def static_assets():
+    '''The static responses, built on first use and shared by every model
+    version. A model store may hold them precompressed.'''
+    global STATIC
+
+    with STATIC_LOCK:
+        if STATIC is None:
+            cache_dir = None
+            if app.config['MODEL_STORE'] is not None:
+                cache_dir = Path(app.config['MODEL_STORE']) / PAYLOAD_DIR
+            STATIC = build_static(cache_dir)
+
+    return STATIC
+
+
+def build_assets():
+    peak_geojson, himal_geojson, payloads = static_assets()
+
+    # Take the modification time first so a change made while loading is
+    # picked up by the next check
+    path = model_path()
+    model_mtime = path.stat().st_mtime_ns
+
+    if app.config['MODEL_STORE'] is not None:
+        model, engine, metadata = load_store(path.parent)
+        model_sha256 = metadata['model_sha256']
+    elif app.config['MODEL_ARTIFACT'] is not None:
+        model, header = load_artifact(path)
+        model_sha256 = header['model_sha256']
+
+        engine = PeakEngine.from_geojson(model, peak_geojson, DEFAULTS)
+    else:
+        model = joblib.load(path)
+        model_sha256 = sha256_file(path)
+
+        # The compiled forest scores single expeditions, the sklearn model
+        # large batches
+        engine = PeakEngine.from_geojson(compile_forest(model), peak_geojson,
+                                         DEFAULTS, batch_model=model)
+
+    peak_index = PeakIndex(peak_geojson, engine.peak_ids)
+
+    # The probability cube is optional and only used if it was built from
+    # this model for the same peaks
+    cube = None
+    try:
+        with res.path('mahalangur.assets', 'rfcube.npy') as cube_path, \
+             res.path('mahalangur.assets', 'rfcube.json') as meta_path:
+            if cube_path.exists() and meta_path.exists():
+                cube = ProbabilityCube.load(cube_path, meta_path)
+    except FileNotFoundError:
+        # Before Python 3.9, res.path raises for a missing resource
+        pass
+
+    if cube is not None and (cube.model != model_sha256 or
+                             cube.peak_ids != engine.peak_ids):
+        cube = None
+
+    batcher = None
+    if app.config['MICRO_BATCH_WINDOW']:
+        batcher = MicroBatcher(engine, window=app.config['MICRO_BATCH_WINDOW'],
+                               max_batch=app.config['MICRO_BATCH_SIZE'])
+
+    # Responses depend on the model, so every version has its own cache
+    cache = ResponseCache(maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                          ttl=app.config['RESPONSE_CACHE_TTL'])
+
+    return Assets(
+        model=model,
+        model_sha256=model_sha256,
+        model_path=path,
+        model_mtime=model_mtime,
+        peak_geojson=peak_geojson,
+        himal_geojson=himal_geojson,
+        payloads=payloads,
+        engine=engine,
+        peak_index=peak_index,
+        cube=cube,
+        batcher=batcher,
+        cache=cache
+    )
+
+
+def load_assets():
+    '''Build the assets and swap them in for new requests'''
+    global ASSETS
+
+    assets = build_assets()
+    with RELOAD_LOCK:
+        previous, ASSETS = ASSETS, assets
+
+    if previous is not None:
+        previous.close()
+
+    return assets
+
+
+def _reload():
+    global RELOAD_ERROR
+
+    logger = logging.getLogger('mahalangur.web.app')
+
+    try:
+        assets = load_assets()
+    except Exception as err:
+        RELOAD_ERROR = repr(err)
+        RELOADS.inc('failure')
+        logger.exception('model reload failed')
+    else:
+        RELOAD_ERROR = None
+        RELOADS.inc('success')
+        logger.info('reloaded model {}'.format(assets.model_sha256))
+
+
+def reload_assets():
+    '''Rebuild the assets in a background thread; returns False if a reload
+    is already running'''
+    global RELOAD_THREAD
+
+    with RELOAD_LOCK:
+        if RELOAD_THREAD is not None and RELOAD_THREAD.is_alive():
+            return False
+
+        RELOAD_THREAD = threading.Thread(target=_reload, daemon=True,
+                                         name='mahalangur-reload')
+        RELOAD_THREAD.start()
+
+    return True
+
+
+def reloading():
+    return RELOAD_THREAD is not None and RELOAD_THREAD.is_alive()
+
+
+def _watch_model(interval):
+    # A version that failed to load is not retried until the file changes
+    # again
+    attempted_mtime = None
+    while True:
+        sleep(interval)
+
+        assets = ASSETS
+        try:
+            model_mtime = model_path().stat().st_mtime_ns
+        except OSError:
+            continue
+
+        if model_mtime in (assets.model_mtime, attempted_mtime):
+            continue
 
-    peak_ids  = []
-    peak_data = []
-    for peak in PEAK_GEOJSON['features']:
-        peak_ids.append(peak['id'])
+        if reload_assets():
+            attempted_mtime = model_mtime
 
-        data = {
-            'height': peak['properties']['height'],
-            'himal' : peak['properties']['himal']
-        }
-        for col, value in DEFAULTS.items():
-            data[col] = value[1]
 
-        peak_data.append(data)
-    
-    PEAK_DF = utils.data_matrix(pd.DataFrame(peak_data, index=peak_ids))
+def watch_model(interval):
+    '''Poll the model file every interval seconds and reload on change'''
+    watcher = threading.Thread(target=_watch_model, args=(interval,),
+                               daemon=True, name='mahalangur-watch')
+    watcher.start()
+
+    return watcher
 
 
 ### Prediction
 
 def expedition_data(expedition_form):
+    '''Coerce the form to a complete expedition profile, raising a
+    ValueError for a value the model was not trained with'''
     exped_data = {}
     for col, (dtype, value) in DEFAULTS.items():
         exped_data[col] = dtype(expedition_form.get(col, value))
 
+    PROFILE.validate(exped_data)
+
     return exped_data
 
 
-def predict(expedition_data):
-    exped_df = PEAK_DF.copy(deep=True)
-    utils.update_data_matrix(exped_df, data=expedition_data,
-                             ignore_cols={'himal', 'height'})
+def profile_key(expedition_data):
+    return tuple(expedition_data[col] for col in DEFAULTS)
+
+
+def peak_rows(expedition_form, assets=None):
+    '''Rows of the peaks in the requested bbox or himal, or None for all'''
+    assets = ASSETS if assets is None else assets
+
+    if 'bbox' in expedition_form:
+        return assets.peak_index.within(expedition_form['bbox'])
+    elif 'himal' in expedition_form:
+        return assets.peak_index.in_himal(str(expedition_form['himal']))
+    else:
+        return None
+
+
+def predict(expedition_data, rows=None, assets=None):
+    assets = ASSETS if assets is None else assets
+    engine = assets.engine
+
+    success = None
+    if assets.cube is not None:
+        with STAGE_SECONDS.time('cube'):
+            success = assets.cube.predict(expedition_data)
+
+        if success is not None and rows is not None:
+            success = success[rows]
+
+    if success is None and rows is None and assets.batcher is not None:
+        with STAGE_SECONDS.time('microbatch'):
+            success = assets.batcher.predict_proba(expedition_data)
+            success = (100*success).round(2)
+    elif success is None:
+        with STAGE_SECONDS.time('encode'):
+            X = engine.encode(expedition_data, rows)
+        with STAGE_SECONDS.time('predict_proba'):
+            success = (100*engine.score(X)).round(2)
+
+    if rows is None:
+        peak_ids = engine.peak_ids
+    else:
+        peak_ids = [engine.peak_ids[row] for row in rows]
+
+    return dict(zip(peak_ids, success.tolist()))
+
 
-    success = MODEL.predict_proba(exped_df)[:, 1]
-    peaks = exped_df.index
+def predict_batch(expeditions, assets=None):
+    assets = ASSETS if assets is None else assets
 
-    return {peak: round(100*prob, 2) for peak, prob in zip(peaks, success)}
+    success = assets.engine.predict_proba_batch(expeditions)
+    return (100*success).round(2).tolist()
+
+
+### Metrics
+
+def collect_cache():
+    if ASSETS is None:
+        return []
+
+    stats = ASSETS.cache.stats()
+    return (
+        gauge_lines('mahalangur_cache_hits_total', 'Response cache hits',
+                    stats['hits'], metric_type='counter') +
+        gauge_lines('mahalangur_cache_misses_total', 'Response cache misses',
+                    stats['misses'], metric_type='counter') +
+        gauge_lines('mahalangur_cache_entries', 'Response cache entries',
+                    stats['size'])
+    )
+
+
+def collect_microbatch():
+    if ASSETS is None or ASSETS.batcher is None:
+        return []
+
+    batcher = ASSETS.batcher
+    stats = batcher.stats()
+    return (
+        gauge_lines('mahalangur_microbatch_batches_total',
+                    'Micro-batches scored', stats['batches'],
+                    metric_type='counter') +
+        gauge_lines('mahalangur_microbatch_requests_total',
+                    'Requests scored in micro-batches', stats['requests'],
+                    metric_type='counter') +
+        gauge_lines('mahalangur_microbatch_queue_wait_seconds_total',
+                    'Total seconds requests waited for their batch',
+                    batcher.queue_wait_total, metric_type='counter') +
+        gauge_lines('mahalangur_microbatch_queue_wait_seconds_max',
+                    'Longest wait in seconds for a batch',
+                    stats['max_queue_wait'])
+    )
+
+
+def collect_model():
+    if ASSETS is None:
+        return []
+
+    return ['# HELP mahalangur_model_info Version of the model being served',
+            '# TYPE mahalangur_model_info gauge',
+            'mahalangur_model_info{{version="{}"}} 1'.format(
+                ASSETS.model_sha256)]
+
+
+METRICS.collectors.extend([collect_cache, collect_microbatch, collect_model])
 
 
 ### Web Application
 
+@app.before_request
+def start_request_timer():
+    g.request_start = perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(perf_counter() - g.request_start, endpoint)
+    REQUESTS.inc(endpoint, str(response.status_code))
+
+    return response
+
 @app.route('/')
 @app.route('/index')
 def index():
-    return render_template('map.j2', peak_geojson=PEAK_GEOJSON,
-                           himal_geojson=HIMAL_GEOJSON)
+    return ASSETS.payloads['index'].response(request)
+
+@app.route('/geojson/peak')
+def peak_geojson():
+    return ASSETS.payloads['peak_geojson'].response(request)
+
+@app.route('/geojson/himal')
+def himal_geojson():
+    return ASSETS.payloads['himal_geojson'].response(request)
 
 @app.route('/api/v1/', methods=['POST'])
 def api_v1():
+    assets = ASSETS
+    try:
+        with STAGE_SECONDS.time('parse'):
+            exped_form = request.get_json()
+        with STAGE_SECONDS.time('coerce'):
+            exped_data = expedition_data(exped_form)
+
+        # Bounding boxes rarely repeat, so only whole catalogue and himal
+        # responses are cached
+        key = None
+        if 'bbox' not in exped_form:
+            key = (profile_key(exped_data), exped_form.get('himal'))
+
+        with STAGE_SECONDS.time('cache'):
+            body = None if key is None else assets.cache.get(key)
+
+        if body is None:
+            with STAGE_SECONDS.time('lookup'):
+                rows = peak_rows(exped_form, assets)
+
+            summit_probabilities = predict(exped_data, rows, assets)
+
+            with STAGE_SECONDS.time('serialize'):
+                body = json.dumps({
+                    'status': 'success',
+                    'model_version': assets.model_sha256,
+                    'summit_probabilities': summit_probabilities
+                }, separators=(',', ':'))
+
+            if key is not None:
+                assets.cache.put(key, body)
+
+        return app.response_class(body, mimetype='application/json')
+    except:
+        API_FAILURES.inc('api_v1')
+        return jsonify({'status': 'failure'})
+
+@app.route('/api/v1/batch', methods=['POST'])
+def api_v1_batch():
+    assets = ASSETS
     try:
-        exped_form = request.get_json()
-        exped_data = expedition_data(exped_form)
-        return jsonify({
-            'status': 'success',
-            'summit_probabilities': predict(exped_data)
-        })
+        with STAGE_SECONDS.time('parse'):
+            exped_forms = request.get_json()['profiles']
+
+        max_profiles = app.config['BATCH_MAX_PROFILES']
+        if len(exped_forms) > max_profiles:
+            API_FAILURES.inc('api_v1_batch')
+            return jsonify({
+                'status': 'failure',
+                'message': 'at most {} profiles per batch'.format(max_profiles)
+            })
+
+        with STAGE_SECONDS.time('coerce'):
+            expeditions = [expedition_data(form) for form in exped_forms]
+        with STAGE_SECONDS.time('predict_batch'):
+            summit_probabilities = predict_batch(expeditions, assets)
+        with STAGE_SECONDS.time('serialize'):
+            return jsonify({
+                'status': 'success',
+                'model_version': assets.model_sha256,
+                'peak_ids': assets.engine.peak_ids,
+                'summit_probabilities': summit_probabilities
+            })
     except:
+        API_FAILURES.inc('api_v1_batch')
         return jsonify({'status': 'failure'})
 
+@app.route('/api/v1/cache', methods=['GET'])
+def api_v1_cache():
+    return jsonify(ASSETS.cache.stats())
+
+@app.route('/api/v1/microbatch', methods=['GET'])
+def api_v1_microbatch():
+    batcher = ASSETS.batcher
+    if batcher is None:
+        return jsonify({'enabled': False})
+
+    return jsonify(dict(batcher.stats(), enabled=True))
+
+@app.route('/admin/reload', methods=['GET', 'POST'])
+def admin_reload():
+    token = app.config['ADMIN_TOKEN']
+    given = request.headers.get('X-Admin-Token', '')
+    if token is None or not hmac.compare_digest(given, token):
+        return jsonify({'status': 'failure'}), 403
+
+    started = reload_assets() if request.method == 'POST' else False
+
+    return jsonify({
+        'status': 'success',
+        'model_version': ASSETS.model_sha256,
+        'reload_started': started,
+        'reloading': reloading(),
+        'last_error': RELOAD_ERROR
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(METRICS.expose(),
+                              content_type=METRICS.content_type)
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
     load_assets()
+    if app.config['RELOAD_POLL_INTERVAL']:
+        watch_model(app.config['RELOAD_POLL_INTERVAL'])
+
     app.run(debug=True)
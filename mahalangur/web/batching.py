@@ -0,0 +1,133 @@
+import queue
+import threading
+from collections import Counter
+from time import monotonic
+
+
+class _Pending:
+    '''An expedition waiting to be scored by the micro-batcher'''
+
+    def __init__(self, expedition_data):
+        self.expedition_data = expedition_data
+        self.enqueued = monotonic()
+        self.done     = threading.Event()
+        self.result   = None
+        self.error    = None
+
+
+class MicroBatcher:
+    '''Coalesces concurrent predictions into a single model evaluation. The
+    first request to arrive opens a window of window seconds; every request
+    that arrives before it closes, up to max_batch, is scored in the same
+    predict_proba call.'''
+
+    def __init__(self, engine, window=0.002, max_batch=32):
+        if window <= 0:
+            raise ValueError('window={} must be positive'.format(window))
+
+        self.engine    = engine
+        self.window    = window
+        self.max_batch = max_batch
+
+        self.batch_sizes = Counter()
+        self.queue_wait_total = 0.0
+        self.queue_wait_max   = 0.0
+
+        self._queue  = queue.Queue()
+        self._lock   = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='mahalangur-microbatch')
+        self._thread.start()
+
+    def predict_proba(self, expedition_data):
+        '''Summit probability for each peak, blocking until the batch that
+        includes this expedition has been scored'''
+        pending = _Pending(expedition_data)
+
+        # Queue under the lock so nothing can land behind the close sentinel
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(pending)
+
+        if closed:
+            return self.engine.predict_proba(expedition_data)
+
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.result
+
+    def close(self):
+        '''Stop the batching thread once queued requests have been scored;
+        later requests are scored directly'''
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+
+            batch = [first]
+            deadline = first.enqueued + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - monotonic()
+                try:
+                    pending = self._queue.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    break
+
+                if pending is None:
+                    stopping = True
+                    break
+
+                batch.append(pending)
+
+            self._score(batch)
+
+    def _score(self, batch):
+        start = monotonic()
+
+        try:
+            success = self.engine.predict_proba_batch(
+                [pending.expedition_data for pending in batch])
+            for pending, result in zip(batch, success):
+                pending.result = result
+        except Exception as err:
+            for pending in batch:
+                pending.error = err
+
+        with self._lock:
+            self.batch_sizes[len(batch)] += 1
+            for pending in batch:
+                wait = start - pending.enqueued
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+
+        for pending in batch:
+            pending.done.set()
+
+    def stats(self):
+        with self._lock:
+            batches  = sum(self.batch_sizes.values())
+            requests = sum(size*n for size, n in self.batch_sizes.items())
+
+            return {
+                'window'         : self.window,
+                'max_batch'      : self.max_batch,
+                'batches'        : batches,
+                'requests'       : requests,
+                'mean_batch_size': requests/batches if batches else None,
+                'batch_sizes'    : dict(sorted(self.batch_sizes.items())),
+                'mean_queue_wait': (self.queue_wait_total/requests
+                                    if requests else None),
+                'max_queue_wait' : self.queue_wait_max
+            }
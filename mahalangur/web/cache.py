@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class ResponseCache:
+    '''Thread-safe LRU cache with time-to-live eviction. A ttl of None keeps
+    entries until they are pushed out by newer ones.'''
+
+    def __init__(self, maxsize=256, ttl=3600.0):
+        if maxsize < 1:
+            msg = 'maxsize={} must be a positive integer'.format(maxsize)
+            raise ValueError(msg)
+
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.hits    = 0
+        self.misses  = 0
+
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size'   : len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl'    : self.ttl,
+                'hits'   : self.hits,
+                'misses' : self.misses
+            }
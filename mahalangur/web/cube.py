@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import logging
+import numpy as np
+from .. import LOG_FORMAT, MODEL_DIR
+from tqdm import tqdm
+
+
+### Globals
+
+CUBE_PATH      = (MODEL_DIR / 'rfcube.npy' ).resolve()
+CUBE_META_PATH = (MODEL_DIR / 'rfcube.json').resolve()
+
+# Probabilities are stored as hundredths of a percent so that a cube lookup
+# returns the same value as the live prediction rounded to two decimals
+CUBE_DTYPE = np.uint16
+CUBE_SCALE = 100
+
+# Input values to precompute, keyed by expedition_data column. Every column of
+# the expedition data must be present; anything outside the grid falls back to
+# live inference
+CUBE_GRID = {
+    'expedition_year' : [2020],
+    'season'          : ['Spring', 'Summer', 'Autumn', 'Winter'],
+    'commercial_route': ['N', 'Y'],
+    'total_members'   : list(range(1, 13)),
+    'total_hired'     : list(range(0, 10)),
+    'age'             : list(range(20, 70, 5)),
+    'sex'             : ['M', 'F'],
+    'o2_used'         : ['N', 'Y']
+}
+
+
+### Logic
+
+def build_cube(engine, cube_path, grid=CUBE_GRID, batch_size=256):
+    '''Evaluate every grid profile against every peak and write the quantized
+    probabilities to a (grid..., peaks) .npy array'''
+    columns = list(grid)
+    shape = [len(grid[col]) for col in columns] + [len(engine.peak_ids)]
+
+    cube = np.lib.format.open_memmap(cube_path, mode='w+', dtype=CUBE_DTYPE,
+                                     shape=tuple(shape))
+    flat_cube = cube.reshape(-1, shape[-1])
+
+    profiles = itertools.product(*[grid[col] for col in columns])
+    n_profiles = flat_cube.shape[0]
+
+    prog_bar = tqdm(total=n_profiles, unit='profiles', leave=False)
+    for start in range(0, n_profiles, batch_size):
+        batch = [dict(zip(columns, values))
+                 for values in itertools.islice(profiles, batch_size)]
+
+        success = engine.predict_proba_batch(batch)
+        quantized = np.rint(100*CUBE_SCALE*success)
+        flat_cube[start:start+len(batch)] = quantized.astype(CUBE_DTYPE)
+
+        prog_bar.update(len(batch))
+
+    prog_bar.close()
+    cube.flush()
+
+    return cube_path
+
+
+class ProbabilityCube:
+    '''Memory-mapped lookup table of precomputed summit probabilities'''
+
+    def __init__(self, cube_path, metadata):
+        self.cube     = np.load(cube_path, mmap_mode='r')
+        self.columns  = metadata['columns']
+        self.peak_ids = metadata['peak_ids']
+        self.model    = metadata['model_sha256']
+
+        self.lookup_tables = [
+            {value: i for i, value in enumerate(metadata['grid'][col])}
+            for col in self.columns
+        ]
+
+    @classmethod
+    def load(cls, cube_path, meta_path):
+        with open(meta_path, 'r') as meta_file:
+            metadata = json.load(meta_file)
+
+        return cls(cube_path, metadata)
+
+    def index(self, expedition_data):
+        '''Grid index of the expedition, or None if it is outside the grid'''
+        index = []
+        for col, lookup in zip(self.columns, self.lookup_tables):
+            i = lookup.get(expedition_data[col])
+            if i is None:
+                return None
+            index.append(i)
+
+        return tuple(index)
+
+    def predict(self, expedition_data):
+        '''Summit percentages ordered as peak_ids, or None outside the grid'''
+        index = self.index(expedition_data)
+        if index is None:
+            return None
+
+        return self.cube[index] / CUBE_SCALE
+
+
+def cube_metadata(engine, model_sha256, grid=CUBE_GRID):
+    return {
+        'model_sha256': model_sha256,
+        'columns'     : list(grid),
+        'grid'        : grid,
+        'peak_ids'    : engine.peak_ids
+    }
+
+
+def probability_cube():
+    from . import app
+
+    logger = logging.getLogger('mahalangur.web.cube')
+
+    logger.info('loading assets')
+    assets = app.load_assets()
+
+    if not CUBE_PATH.parent.exists():
+        CUBE_PATH.parent.mkdir(parents=True)
+
+    logger.info('evaluating grid to cube \'{}\''.format(CUBE_PATH.name))
+    build_cube(assets.engine, CUBE_PATH)
+
+    logger.info('writing cube metadata \'{}\''.format(CUBE_META_PATH.name))
+    with open(CUBE_META_PATH, 'w') as meta_file:
+        json.dump(cube_metadata(assets.engine, assets.model_sha256),
+                  meta_file)
+
+    return (CUBE_PATH, CUBE_META_PATH)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    probability_cube()
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import threading
+from ..feat import utils
+
+
+### Globals
+
+PEAK_COLS = {'height', 'himal'}
+
+# The compiled forest is fastest for small matrices, but its cost grows
+# faster than sklearn's with the number of rows, so larger matrices are
+# scored by the sklearn model when one is loaded
+COMPILED_MAX_ROWS = 512
+
+
+### Logic
+
+def peak_dataframe(peak_geojson, defaults):
+    '''Create a dataframe of per-peak records from the peak geojson, filling
+    the expedition-level columns with the default values'''
+    peak_ids  = []
+    peak_data = []
+    for peak in peak_geojson['features']:
+        peak_ids.append(peak['id'])
+
+        data = {
+            'height': peak['properties']['height'],
+            'himal' : peak['properties']['himal']
+        }
+        for col, value in defaults.items():
+            data[col] = value[1]
+
+        peak_data.append(data)
+
+    return pd.DataFrame(peak_data, index=peak_ids)
+
+
+class PeakEngine:
+    '''Scores an expedition against every peak using a preallocated feature
+    matrix. The per-peak columns are encoded once; only the expedition-level
+    columns are overwritten for each prediction. Matrices of more than
+    batch_rows rows are scored by batch_model instead, if given.'''
+
+    def __init__(self, model, peak_ids, columns, base,
+                 schema=utils.DATA_SCHEMA, batch_model=None,
+                 batch_rows=COMPILED_MAX_ROWS):
+        self.model       = model
+        self.batch_model = batch_model
+        self.batch_rows  = batch_rows
+        self.schema   = schema
+        self.peak_ids = list(peak_ids)
+        self.columns  = list(columns)
+
+        self.profile = utils.ProfileEncoder(schema, ignore_cols=PEAK_COLS)
+        self.exped_idx = np.array([self.columns.index(col)
+                                   for col in self.profile.columns])
+
+        # Trees evaluate in float32, so store the matrix that way to avoid a
+        # conversion copy inside predict_proba. A memory-mapped float32 base
+        # is used without copying; each thread fills its own copy.
+        self.base = np.ascontiguousarray(base, dtype=np.float32)
+
+        self._local = threading.local()
+
+    @classmethod
+    def from_geojson(cls, model, peak_geojson, defaults,
+                     schema=utils.DATA_SCHEMA, **kwargs):
+        peak_df = utils.data_matrix(peak_dataframe(peak_geojson, defaults),
+                                    schema=schema)
+
+        return cls(model, peak_df.index, peak_df.columns, peak_df.values,
+                   schema=schema, **kwargs)
+
+    def exped_vector(self, expedition_data):
+        return self.profile.encode(expedition_data)
+
+    def feature_matrix(self, expedition_data):
+        '''Fill this thread's copy of the peak matrix with the expedition'''
+        X = getattr(self._local, 'X', None)
+        if X is None:
+            X = self._local.X = self.base.copy()
+
+        X[:, self.exped_idx] = self.exped_vector(expedition_data)
+
+        return X
+
+    def batch_matrix(self, expeditions):
+        '''Stack one copy of the peak matrix per expedition, giving a
+        (expeditions x peaks, columns) matrix'''
+        n_peaks = len(self.peak_ids)
+
+        X = np.tile(self.base, (len(expeditions), 1))
+        exped_X = np.array([self.exped_vector(exped) for exped in expeditions],
+                           dtype=np.float32)
+        X[:, self.exped_idx] = np.repeat(exped_X, n_peaks, axis=0)
+
+        return X
+
+    def encode(self, expedition_data, rows=None):
+        '''Feature matrix of the expedition against every peak, or against
+        the peaks at the given rows only'''
+        if rows is None:
+            return self.feature_matrix(expedition_data)
+
+        X = self.base[rows]
+        X[:, self.exped_idx] = self.exped_vector(expedition_data)
+
+        return X
+
+    def score(self, X):
+        if X.shape[0] == 0:
+            return np.empty(0)
+
+        model = self.model
+        if self.batch_model is not None and X.shape[0] > self.batch_rows:
+            model = self.batch_model
+
+        return model.predict_proba(X)[:, 1]
+
+    def predict_proba(self, expedition_data, rows=None):
+        '''Summit probability for each peak, ordered as peak_ids, or for the
+        peaks at the given rows only'''
+        return self.score(self.encode(expedition_data, rows))
+
+    def predict_proba_batch(self, expeditions):
+        '''Summit probabilities as an (expeditions, peaks) array from a single
+        model evaluation'''
+        if not expeditions:
+            return np.empty((0, len(self.peak_ids)))
+
+        success = self.score(self.batch_matrix(expeditions))
+
+        return success.reshape(len(expeditions), len(self.peak_ids))
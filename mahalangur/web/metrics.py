@@ -0,0 +1,146 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+
+### Globals
+
+# Seconds; fine-grained at the low end where most stages fall
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+### Logic
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name          = name
+        self.documentation = documentation
+        self.labelnames    = tuple(labelnames)
+
+        self._values = {}
+        self._lock   = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            value = self._values.get(labelvalues, 0)
+            self._values[labelvalues] = value + amount
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} counter'.format(self.name)]
+
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                labels = format_labels(self.labelnames, labelvalues)
+                lines.append('{}{} {}'.format(self.name, labels,
+                                              format_value(value)))
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name          = name
+        self.documentation = documentation
+        self.labelnames    = tuple(labelnames)
+        self.buckets       = tuple(buckets)
+
+        # labelvalues -> [per-bucket counts (last is +Inf), sum]
+        self._values = {}
+        self._lock   = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                counts = self._values[labelvalues] = [
+                    [0]*(len(self.buckets) + 1), 0.0]
+
+            counts[0][i] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labelvalues)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+
+        with self._lock:
+            for labelvalues, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    labels = format_labels(self.labelnames, labelvalues,
+                                           extra=[('le', le)])
+                    lines.append('{}_bucket{} {}'.format(self.name, labels,
+                                                         cumulative))
+
+                labels = format_labels(self.labelnames, labelvalues)
+                lines.append('{}_sum{} {}'.format(self.name, labels,
+                                                  format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, labels,
+                                                    cumulative))
+
+        return lines
+
+
+class Registry:
+    '''Collection of metrics exposed in the Prometheus text format. Collectors
+    are callables returning extra exposition lines, read at scrape time.'''
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics    = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for collector in self.collectors:
+            lines.extend(collector())
+
+        return '\n'.join(lines) + '\n'
+
+
+def gauge_lines(name, documentation, value, metric_type='gauge'):
+    '''Exposition lines for a single unlabelled value'''
+    return ['# HELP {} {}'.format(name, documentation),
+            '# TYPE {} {}'.format(name, metric_type),
+            '{} {}'.format(name, format_value(value))]
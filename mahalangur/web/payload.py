@@ -0,0 +1,92 @@
+import gzip
+import hashlib
+import os
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODING_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+class Payload:
+    '''A static response body that is compressed once up front and served
+    with a strong ETag per content encoding. Compressed bodies written by
+    write_encodings to cache_dir are read instead of compressing again.'''
+
+    def __init__(self, body, mimetype, cache_control='no-cache',
+                 cache_dir=None):
+        self.body          = body
+        self.mimetype      = mimetype
+        self.cache_control = cache_control
+
+        digest = hashlib.sha256(body).hexdigest()
+        self.digest = digest
+
+        self.encoded = {None: body}
+        for encoding in ['gzip', 'br']:
+            cached = self.cache_path(cache_dir, encoding)
+            if cached is not None and cached.exists():
+                with open(cached, 'rb') as cached_file:
+                    self.encoded[encoding] = cached_file.read()
+            elif encoding == 'gzip':
+                self.encoded[encoding] = gzip.compress(body, 9)
+            elif brotli is not None:
+                self.encoded[encoding] = brotli.compress(body)
+
+        # Each encoding is a different representation, so it gets its own tag
+        self.etags = {None: digest}
+        for encoding in self.encoded:
+            if encoding is not None:
+                self.etags[encoding] = digest + '-' + encoding
+
+    def cache_path(self, cache_dir, encoding):
+        if cache_dir is None:
+            return None
+
+        return cache_dir / (self.digest + ENCODING_SUFFIXES[encoding])
+
+    def write_encodings(self, cache_dir):
+        '''Write the compressed bodies to cache_dir, named by the hash of the
+        body so that a changed body is never served a stale encoding'''
+        if not cache_dir.exists():
+            cache_dir.mkdir(parents=True)
+
+        for encoding, encoded in self.encoded.items():
+            if encoding is None:
+                continue
+
+            cache_path = self.cache_path(cache_dir, encoding)
+            temp_path = cache_path.with_name(cache_path.name + '.tmp')
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(encoded)
+            os.replace(temp_path, cache_path)
+
+    def encoding(self, request):
+        '''Preferred encoding accepted by the client, or None for identity'''
+        for encoding in ['br', 'gzip']:
+            if encoding in self.encoded and request.accept_encodings[encoding]:
+                return encoding
+
+        return None
+
+    def response(self, request):
+        encoding = self.encoding(request)
+        etag = self.etags[encoding]
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.encoded[encoding],
+                                mimetype=self.mimetype)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = self.cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        return response
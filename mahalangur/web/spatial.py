@@ -0,0 +1,79 @@
+import math
+import numpy as np
+from collections import defaultdict
+
+
+class PeakIndex:
+    '''Grid index of peak coordinates for bounding box and himal lookups.
+    Rows refer to positions in peak_ids, which is usually the order of the
+    prediction engine.'''
+
+    def __init__(self, peak_geojson, peak_ids, cell_size=0.25):
+        self.cell_size = cell_size
+
+        rows = {peak_id: i for i, peak_id in enumerate(peak_ids)}
+
+        peak_rows = []
+        coords    = []
+        himals    = defaultdict(list)
+        for peak in peak_geojson['features']:
+            row = rows.get(peak['id'])
+            if row is None:
+                continue
+
+            peak_rows.append(row)
+            coords.append(peak['geometry']['coordinates'][:2])
+            himals[peak['properties']['himal']].append(row)
+
+        self.rows = np.array(peak_rows, dtype=np.int64)
+        self.lon, self.lat = np.array(coords, dtype=np.float64).T
+
+        self.himals = {himal: np.sort(np.array(himal_rows, dtype=np.int64))
+                       for himal, himal_rows in himals.items()}
+
+        # Positions into self.rows for each occupied grid cell
+        cells = defaultdict(list)
+        for i, (lon, lat) in enumerate(coords):
+            cells[self.cell(lon, lat)].append(i)
+
+        self.cells = {cell: np.array(members, dtype=np.int64)
+                      for cell, members in cells.items()}
+
+    def cell(self, lon, lat):
+        return (math.floor(lon / self.cell_size),
+                math.floor(lat / self.cell_size))
+
+    def within(self, bbox):
+        '''Sorted rows of the peaks inside (min_lon, min_lat, max_lon,
+        max_lat)'''
+        min_lon, min_lat, max_lon, max_lat = [float(v) for v in bbox]
+        if min_lon > max_lon or min_lat > max_lat:
+            raise ValueError('bbox={} has min > max'.format(bbox))
+
+        min_x, min_y = self.cell(min_lon, min_lat)
+        max_x, max_y = self.cell(max_lon, max_lat)
+
+        # Only visit occupied cells when the box covers more cells than exist
+        if (max_x - min_x + 1)*(max_y - min_y + 1) > len(self.cells):
+            candidates = [members for (x, y), members in self.cells.items()
+                          if min_x <= x <= max_x and min_y <= y <= max_y]
+        else:
+            candidates = [self.cells[(x, y)]
+                          for x in range(min_x, max_x + 1)
+                          for y in range(min_y, max_y + 1)
+                          if (x, y) in self.cells]
+
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+
+        members = np.concatenate(candidates)
+        lon = self.lon[members]
+        lat = self.lat[members]
+        inside = ((min_lon <= lon) & (lon <= max_lon) &
+                  (min_lat <= lat) & (lat <= max_lat))
+
+        return np.sort(self.rows[members[inside]])
+
+    def in_himal(self, himal):
+        '''Sorted rows of the peaks assigned to the himal'''
+        return self.himals.get(himal, np.empty(0, dtype=np.int64))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import numpy as np
+import os
+from .engine import PeakEngine
+from .. import LOG_FORMAT, MODEL_DIR
+from ..forest import FOREST_ARRAYS, CompiledForest, check_forest
+
+
+### Globals
+
+STORE_DIR = (MODEL_DIR / 'store').resolve()
+
+# Subdirectory of the store holding the precompressed static payloads
+PAYLOAD_DIR = 'payload'
+
+
+### Logic
+
+def export_store(rf_model, engine, model_sha256, store_dir=STORE_DIR,
+                 payloads={}):
+    '''Write the compiled forest arrays and the peak feature matrix to a
+    directory of .npy files that worker processes can memory-map read-only.
+    The engine must score with the compiled form of rf_model. The compressed
+    bodies of the static payloads are written too, so that workers do not
+    compress them on start-up.'''
+    if not store_dir.exists():
+        store_dir.mkdir(parents=True)
+
+    for payload in payloads.values():
+        payload.write_encodings(store_dir / PAYLOAD_DIR)
+
+    check_forest(rf_model, engine.model, engine.base)
+
+    arrays = engine.model.arrays()
+    arrays['peak_X'] = engine.base
+
+    # Replace rather than overwrite files, since a running server may have
+    # the previous arrays memory-mapped. The metadata goes last, so a watcher
+    # of store.json sees a complete store.
+    for name, array in arrays.items():
+        temp_path = store_dir / (name + '.npy.tmp')
+        with open(temp_path, 'wb') as npy_file:
+            np.save(npy_file, np.ascontiguousarray(array))
+        os.replace(temp_path, store_dir / (name + '.npy'))
+
+    metadata = {
+        'model_sha256': model_sha256,
+        'classes'     : rf_model.classes_.tolist(),
+        'peak_ids'    : engine.peak_ids,
+        'columns'     : engine.columns
+    }
+    temp_path = store_dir / 'store.json.tmp'
+    with open(temp_path, 'w') as meta_file:
+        json.dump(metadata, meta_file)
+    os.replace(temp_path, store_dir / 'store.json')
+
+    return store_dir
+
+
+def load_store(store_dir=STORE_DIR):
+    '''Memory-map a store written by export_store, returning the forest, the
+    engine and the store metadata'''
+    with open(store_dir / 'store.json', 'r') as meta_file:
+        metadata = json.load(meta_file)
+
+    arrays = {name: np.load(store_dir / (name + '.npy'), mmap_mode='r')
+              for name in FOREST_ARRAYS + ['peak_X']}
+
+    forest = CompiledForest(arrays, metadata['classes'])
+    engine = PeakEngine(forest, metadata['peak_ids'], metadata['columns'],
+                        arrays['peak_X'])
+
+    return forest, engine, metadata
+
+
+def model_store():
+    from . import app
+
+    logger = logging.getLogger('mahalangur.web.store')
+
+    logger.info('loading assets')
+    app.app.config['MODEL_STORE'] = None
+    app.app.config['MODEL_ARTIFACT'] = None
+    assets = app.load_assets()
+
+    logger.info('exporting model store to \'{}\''.format(STORE_DIR))
+    return export_store(assets.model, assets.engine, assets.model_sha256,
+                        payloads=assets.payloads)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    model_store()
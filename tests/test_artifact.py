@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from mahalangur.artifact import (VALUE_SCALE, load_artifact, read_header,
+                                 threshold_float32, write_artifact)
+from mahalangur.forest import CompiledForest, compile_forest
+from sklearn.ensemble import RandomForestClassifier
+
+
+### Fixtures
+
+N_FEATURES = 5
+
+
+@pytest.fixture
+def rf_model():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(500, N_FEATURES)).astype(np.float32)
+    y = (X[:, 0] + X[:, 1]**2 + rng.normal(scale=0.5, size=500) > 1)
+    return RandomForestClassifier(n_estimators=15, max_depth=6,
+                                  random_state=0).fit(X, y.astype(np.uint8))
+
+
+def threshold_rows(rf_model, n_rows=2000, seed=1):
+    '''Rows whose features lie on and next to the split thresholds'''
+    thresholds = np.concatenate([estimator.tree_.threshold for estimator
+                                 in rf_model.estimators_])
+    thresholds32 = thresholds[thresholds != -2].astype(np.float32)
+    values = np.concatenate([thresholds32,
+                             np.nextafter(thresholds32, np.float32(np.inf)),
+                             np.nextafter(thresholds32, np.float32(-np.inf))])
+
+    rng = np.random.RandomState(seed)
+    return rng.choice(values, size=(n_rows, N_FEATURES))
+
+
+### Tests
+
+def test_threshold_float32_keeps_comparisons():
+    rng = np.random.RandomState(0)
+    threshold = rng.normal(size=1000)
+    threshold32 = threshold_float32(threshold)
+
+    X = np.concatenate([threshold.astype(np.float32), threshold32,
+                        np.nextafter(threshold32, np.float32(np.inf))])
+    np.testing.assert_array_equal(X[:, np.newaxis] <= threshold,
+                                  X[:, np.newaxis] <= threshold32)
+
+
+def test_artifact_round_trip(rf_model, tmp_path):
+    artifact_path = write_artifact(rf_model, tmp_path / 'model.artifact',
+                                   {'model_sha256': 'abc'})
+    forest, header = load_artifact(artifact_path)
+
+    assert header['model_sha256'] == 'abc'
+    assert header['classes'] == rf_model.classes_.tolist()
+    assert forest.feature.dtype == np.int16
+    assert forest.threshold.dtype == np.float32
+    assert forest.value.dtype == np.uint16
+    assert isinstance(forest.value, np.memmap)
+
+    with open(artifact_path, 'rb') as artifact_file:
+        _, data_start = read_header(artifact_file)
+    assert data_start % 64 == 0
+
+    X = threshold_rows(rf_model)
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               rf_model.predict_proba(X),
+                               atol=0.5/VALUE_SCALE + 1e-12)
+
+
+def test_artifact_routing_is_exact(rf_model, tmp_path):
+    # With the leaf values of the float64 forest, the compact thresholds and
+    # features must send every row to the same leaves
+    exact = compile_forest(rf_model)
+    compact, _ = load_artifact(write_artifact(rf_model,
+                                              tmp_path / 'model.artifact', {}))
+    forest = CompiledForest({'feature'  : compact.feature,
+                             'threshold': compact.threshold,
+                             'value'    : exact.value}, exact.classes_)
+
+    X = threshold_rows(rf_model)
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               exact.predict_proba(X), atol=1e-12)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from mahalangur.forest import check_forest, compile_forest
+from sklearn.ensemble import RandomForestClassifier
+
+
+### Fixtures
+
+def make_data(n_rows=400, n_features=6, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.randint(0, 5, size=(n_rows, n_features)).astype(np.float32)
+    y = (X[:, 0] + rng.normal(scale=1.5, size=n_rows) > 2).astype(np.uint8)
+
+    return X, y
+
+
+### Tests
+
+@pytest.mark.parametrize('params', [
+    {'max_depth': 5},
+    # Leaves at uneven depths, pushed down the left-most path when compiled
+    {'max_depth': 8, 'min_samples_leaf': 40},
+    {'max_depth': None}
+])
+def test_compiled_forest_matches_predict_proba(params):
+    X, y = make_data()
+    rf_model = RandomForestClassifier(n_estimators=20, random_state=0,
+                                      **params).fit(X, y)
+
+    forest = compile_forest(rf_model)
+    X_test, _ = make_data(seed=1)
+
+    np.testing.assert_allclose(forest.predict_proba(X_test),
+                               rf_model.predict_proba(X_test), atol=1e-9)
+    check_forest(rf_model, forest, X_test)
+
+
+def test_compiled_forest_with_single_leaf_tree():
+    X, _ = make_data()
+    y = np.zeros(X.shape[0], dtype=np.uint8)
+    y[0] = 1
+    rf_model = RandomForestClassifier(n_estimators=10, max_depth=3,
+                                      random_state=0).fit(X, y)
+    assert min(tree.tree_.max_depth for tree in rf_model.estimators_) == 0
+
+    forest = compile_forest(rf_model)
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               rf_model.predict_proba(X), atol=1e-9)
+
+
+def test_compiled_forest_chunks():
+    X, y = make_data()
+    rf_model = RandomForestClassifier(n_estimators=5, max_depth=4,
+                                      random_state=0).fit(X, y)
+
+    forest = compile_forest(rf_model)
+    forest.chunk_size = 7
+
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               rf_model.predict_proba(X), atol=1e-9)
+
+
+def test_compile_forest_refuses_deep_forests():
+    X, y = make_data()
+    rf_model = RandomForestClassifier(n_estimators=2, max_depth=6,
+                                      random_state=0).fit(X, y)
+
+    with pytest.raises(ValueError):
+        compile_forest(rf_model, max_depth=2)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+pytest.importorskip('Levenshtein')
+pytest.importorskip('shapely')
+
+from mahalangur.feat import peak
+
+
+### Fixtures
+
+HDB_PEAKS = {
+    'AMAD': {'pkname': 'Ama Dablam', 'pkname2': ''},
+    'QZXW': {'pkname': 'Qzxw', 'pkname2': ''}
+}
+
+MOTCA_PEAKS = {
+    '1': {'peak_name': 'Pumori', 'alt_names': ''},
+    '2': {'peak_name': 'Lhotse', 'alt_names': ''}
+}
+
+
+def name_dataframes():
+    return (peak.name_dataframe(HDB_PEAKS, 'pkname', 'pkname2'),
+            peak.name_dataframe(MOTCA_PEAKS, 'peak_name', 'alt_names'))
+
+
+### Tests
+
+def test_unique_pairs_empty():
+    codes, pairs = peak.unique_pairs(np.array([], dtype=object),
+                                     np.array([], dtype=object))
+
+    assert len(codes) == 0
+    assert pairs == []
+
+
+def test_match_names_without_candidates():
+    name1_df, name2_df = name_dataframes()
+
+    match_df = peak.match_names(name1_df, name2_df)
+    assert match_df.empty
+
+    match_df = peak.match_names(name1_df, name2_df, reduce=False)
+    assert match_df.empty
+    assert list(match_df.columns) == peak.MATCH_HEADERS
+
+
+def test_cached_matches_rescore_without_candidates():
+    name1_df, name2_df = name_dataframes()
+    context = peak.match_context('motca')
+
+    matches, cache, _ = peak.cached_matches(name1_df, name2_df, {}, context)
+    assert matches == {'AMAD': None, 'QZXW': None}
+
+    matches, _, n_reused = peak.cached_matches(
+        name1_df, name2_df, cache, context, extras={'QZXW': ['1']})
+    assert n_reused == 1
+    assert matches == {'AMAD': None, 'QZXW': None}
+
+
+def test_weighted_vectorizer_matches_fit():
+    name1_df, name2_df = name_dataframes()
+    name_vectorizer = peak.fit_vectorizer(name1_df['name'])
+    weighted = peak.weighted_vectorizer(
+        peak.vectorizer_weights(name_vectorizer))
+
+    names = list(name1_df['name']) + list(name2_df['name'])
+    assert (name_vectorizer.transform(names) !=
+            weighted.transform(names)).nnz == 0
+
+
+def test_cached_matches_keep_weights():
+    name1_df, name2_df = name_dataframes()
+    context = peak.match_context('motca')
+    _, cache, _ = peak.cached_matches(name1_df, name2_df, {}, context)
+
+    # Renaming a peak rescores it alone, with the cached weights
+    name1_df.loc[name1_df['id'] == 'QZXW', 'name'] = 'QZXW WEST'
+    _, new_cache, n_reused = peak.cached_matches(name1_df, name2_df, cache,
+                                                 context)
+    assert n_reused == 1
+    assert new_cache['weights'] == cache['weights']
+
+    _, new_cache, n_reused = peak.cached_matches(
+        name1_df, name2_df, cache, peak.match_context('osm'))
+    assert n_reused == 0
+    assert new_cache['weights'] != cache['weights']
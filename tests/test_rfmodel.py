@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import logging
+import numpy as np
+from mahalangur.rfmodel import collapse_rows, fit_rows
+from sklearn.ensemble import RandomForestClassifier
+
+
+### Fixtures
+
+def make_data(n_rows=600, seed=0):
+    '''Rows with few distinct values, so many of them are duplicates'''
+    rng = np.random.RandomState(seed)
+    X = rng.randint(0, 3, size=(n_rows, 4)).astype(np.float32)
+    y = (X.sum(axis=1) + rng.normal(size=n_rows) > 4).astype(np.uint8)
+
+    return X, y
+
+
+### Tests
+
+def test_collapse_rows_counts():
+    X, y = make_data()
+    X_unique, y_unique, sample_weight = collapse_rows(X, y)
+
+    assert X_unique.shape[0] < X.shape[0]
+    assert sample_weight.sum() == X.shape[0]
+
+    Xy = np.column_stack([X, y])
+    for row, target, weight in zip(X_unique, y_unique, sample_weight):
+        count = (Xy == np.append(row, target)).all(axis=1).sum()
+        assert count == weight
+
+
+def test_collapsed_fit_matches_full_fit():
+    # Without bootstrapping and feature sampling, weighting the unique rows
+    # by their counts is the same fit as on every row
+    X, y = make_data()
+    params = {'n_estimators': 10, 'max_depth': 5, 'bootstrap': False,
+              'max_features': None, 'random_state': 0}
+
+    full_model = RandomForestClassifier(**params).fit(X, y)
+
+    X_unique, y_unique, sample_weight = collapse_rows(X, y)
+    collapsed_model = RandomForestClassifier(**params).fit(
+        X_unique, y_unique, sample_weight=sample_weight)
+
+    X_test, _ = make_data(seed=1)
+    np.testing.assert_allclose(collapsed_model.predict_proba(X_test),
+                               full_model.predict_proba(X_test), atol=1e-12)
+
+
+def test_collapsed_bootstrap_warns(caplog):
+    X, y = make_data()
+
+    with caplog.at_level(logging.WARNING, logger='mahalangur.rfmodel'):
+        fit_rows(X, y, n_estimators=5)
+    assert not caplog.records
+
+    with caplog.at_level(logging.WARNING, logger='mahalangur.rfmodel'):
+        _, score = fit_rows(X, y, collapse=True, n_estimators=5)
+    assert 'not equivalent' in caplog.text
+    assert 0 <= score <= 1
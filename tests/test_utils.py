@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+from mahalangur.feat import utils
+
+
+### Fixtures
+
+PROFILE = {
+    'expedition_year' : 2019,
+    'season'          : 'Spring',
+    'commercial_route': 'Y',
+    'total_members'   : 12,
+    'total_hired'     : 9,
+    'age'             : 35.3,
+    'sex'             : 'F',
+    'o2_used'         : 'N',
+    'height'          : 8848,
+    'himal'           : 'KHUMBU'
+}
+
+
+### Tests
+
+def test_update_data_matrix_dict_matches_data_matrix():
+    expected_df = utils.data_matrix(pd.DataFrame([PROFILE]))
+
+    model_df = pd.DataFrame(index=expected_df.index)
+    model_df = utils.update_data_matrix(model_df, PROFILE)
+
+    pd.testing.assert_frame_equal(model_df[expected_df.columns], expected_df)
+
+
+def test_update_data_matrix_dict_keeps_dtypes():
+    model_df = utils.data_matrix(pd.DataFrame([PROFILE, PROFILE]))
+    dtypes = model_df.dtypes.copy()
+
+    model_df = utils.update_data_matrix(model_df, {**PROFILE, 'age': 61.7})
+
+    pd.testing.assert_series_equal(model_df.dtypes, dtypes)
+    assert (model_df['age'] == 61.7).all()
+    assert model_df['age'].dtype == np.float64
+    assert model_df['female'].dtype == np.uint8